@@ -27,29 +27,73 @@ CONFIGURATION = {
     # (None  = no autosave)
     'long_pause': 60,
     'midi_file_name': 'midi_notebook_{0}.mid',  # {0} = datetime
+    # raw session archive for midi_notebook_batch.py (None = no archive)
+    'session_file_name': 'midi_notebook_{0}.session',  # {0} = datetime
+    # keep the search index of midi_notebook_search.py up to date
+    'index_midi_files': False,
     'bpm': 120,  # beats per minute for MIDI files
     'monitor': True,  # print input midi messages
     'write_message_function': print,  # loggin function
     'loop_toggle_message_signature':
     [[21, 127], [22, 127], [23, 127], [24, 127], ],
+    # per loop MIDI out port and channel 0-15 (None = -outPORT / as recorded)
+    'loop_output_ports': [None, None, None, None],
+    'loop_output_channels': [None, None, None, None],
+    # localhost UDP port for loop commands (None = disabled)
+    'control_port': None,
+    # quantize loop takes and MIDI files: grid in beats, e.g. 0.25 = 1/16
+    # (None = off), strength 0-1, swing 0-1 of a grid step (1/3 = triplets)
+    'quantize_grid': None,
+    'quantize_strength': 1.0,
+    'quantize_swing': 0.0,
+    # MIDI file tempo detected from the master loop ('loop') or the session
+    # ('session'), None = bpm
+    'tempo_detection': None,
+    # print session statistics every N seconds (None = never)
+    'stats_interval': 30,
 }
 # /CONFIGURATION
 
 
 def cb_signal_handler(signal_sent, frame):
     MidiNotebookContext().save_midi_file()
+    if MidiNotebookContext().profiler is not None:
+        from midi_notebook.midi_notebook_profiler import stop_profiler
+        stop_profiler(MidiNotebookContext())
     MidiNotebookContext().write_message('Bye.')
     sys.exit(0)
 
 
 def main():
     context = MidiNotebookContext(CONFIGURATION)  # init
+    context.scan_ports()  # in background, while arguments are parsed
 
     for arg in sys.argv[1:]:
         if arg.startswith("-in"):
             context.input_port = int(arg[3:])
         if arg.startswith("-out"):
             context.output_port = int(arg[4:])
+        if arg.startswith("-control"):
+            context.control_port = int(arg[8:])
+        if arg.startswith("-quantize"):
+            context.quantize_grid = float(arg[9:])
+        if arg.startswith("-tempo"):
+            if arg[6:] not in context.TEMPO_DETECTION_MODES:
+                context.write_message("Unknown tempo detection {0}.".format(arg[6:]))
+                context.print_info()
+                sys.exit(1)
+            context.tempo_detection = arg[6:]
+        if arg.startswith("--profile"):
+            from midi_notebook.midi_notebook_profiler import Profiler, parse_profile_argument
+            mode = parse_profile_argument(arg)
+            if mode not in Profiler.MODES:
+                context.write_message("Unknown profile mode in {0}.".format(arg))
+                context.print_info()
+                sys.exit(1)
+            context.profiler = Profiler(mode)
+
+    if context.profiler is not None:
+        context.profiler.start()
 
     context.print_info()
     context.start_recording()
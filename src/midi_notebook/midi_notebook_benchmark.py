@@ -0,0 +1,275 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""MIDI Notebook benchmarks.
+
+Usage (from the src directory): python -m midi_notebook.midi_notebook_benchmark NAME
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+# Run in a fresh interpreter: measures a cold start, from the first import to
+# the first MIDI event stored in the session. The event is handed to the input
+# callback directly, so MIDI driver delivery is not included.
+STARTUP_SCRIPT = """
+import time
+t0 = time.perf_counter()
+
+from midi_notebook.midi_notebook_context import MidiNotebookContext
+t_import = time.perf_counter()
+
+context = MidiNotebookContext({
+    'long_pause': None,
+    'midi_file_name': 'midi_notebook_{0}.mid',
+    'bpm': 120,
+    'monitor': False,
+    'loop_toggle_message_signature': [[21, 127], [22, 127], [23, 127], [24, 127], ],
+})
+context.scan_ports()
+context.start_recording()
+t_ready = time.perf_counter()
+
+# the input port callback, called directly with the first note
+context.capture_message_raw([144, 60, 100], 0.0)
+assert len(context.messages_captured) == 1
+t_event = time.perf_counter()
+
+print(t_import - t0, t_ready - t0, t_event - t0)
+"""
+
+
+def benchmark_startup(runs=5):
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+
+    for n in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT], cwd=src_dir)
+        results.append([float(x) for x in output.split()])
+
+    results.sort(key=lambda r: r[2])
+    t_import, t_ready, t_event = results[len(results) // 2]  # median run
+
+    print("startup ({0} runs, median)".format(runs))
+    print("  import context:          {0:8.1f} ms".format(t_import * 1000))
+    print("  ports ready:             {0:8.1f} ms".format(t_ready * 1000))
+    print("  first event handled:     {0:8.1f} ms".format(t_event * 1000))
+    print("  (input callback called directly, MIDI driver delivery excluded)")
+
+
+def simulate_session(minutes=10):
+    """Record three synced loops, let them play, then pause for the
+    autosave; all on a SimulatedClock. Returns the simulated duration, the
+    output events (time, port, message) and the saved files.
+    """
+    from midi_notebook.midi_notebook_context import MidiNotebookContext
+    from midi_notebook.midi_notebook_clock import SimulatedClock
+    from midi_notebook.midi_notebook_virtual import VirtualMidiBackend
+
+    clock = SimulatedClock(start=0.0)
+    backend = VirtualMidiBackend(clock=clock)
+    backend.output_log = []
+    output_dir = tempfile.mkdtemp(prefix='midi_notebook_simulation_')
+
+    MidiNotebookContext.instance = None  # a new session each time
+    context = MidiNotebookContext({
+        'long_pause': 30,
+        'midi_file_name': 'simulation_{0}.mid',
+        'session_file_name': None,
+        'output_dir': output_dir,
+        'bpm': 120,
+        'monitor': False,
+        'loop_toggle_message_signature':
+        [[21, 127], [22, 127], [23, 127], [24, 127], ],
+        'midi_backend': backend,
+        'clock': clock,
+    })
+    context.output_port = 0
+    context.start_recording()
+
+    def run_main_loop():
+        try:
+            context.start_main_loop()
+        finally:
+            clock.remove_thread()
+
+    main_loop = threading.Thread(target=run_main_loop)
+    main_loop.daemon = True
+    clock.add_thread()
+    main_loop.start()
+
+    def toggle(n):
+        backend.send_input(0, [176] + context.loop_toggle_message_signature[n])
+
+    for n, root in enumerate([48, 55, 60]):
+        toggle(n)
+        clock.sleep(1.0)
+        for beat in range(8):  # 4 seconds at 120 bpm
+            backend.send_input(0, [144, root + beat % 4, 100])
+            clock.sleep(0.25)
+            backend.send_input(0, [128, root + beat % 4, 0])
+            clock.sleep(0.25)
+        toggle(n)
+        clock.sleep(1.0)
+
+    clock.sleep(minutes * 60)
+
+    for n in range(3)[::-1]:
+        context.stop_loop(n)
+    clock.sleep(context.long_pause + 10)  # autosave
+
+    files = sorted(os.listdir(output_dir))
+    shutil.rmtree(output_dir, ignore_errors=True)
+    MidiNotebookContext.instance = None
+
+    return clock.time(), backend.output_log, files
+
+
+def benchmark_simulation(minutes=10):
+    start = time.perf_counter()
+    simulated, events, files = simulate_session(minutes)
+    elapsed = time.perf_counter() - start
+
+    simulated_again, events_again, files_again = simulate_session(minutes)
+
+    print("simulation ({0} minutes, 3 synced loops, autosave)".format(minutes))
+    print("  simulated time:          {0:8.1f} sec".format(simulated))
+    print("  wall time:               {0:8.3f} sec".format(elapsed))
+    print("  speed-up:                {0:8.0f} x".format(simulated / elapsed))
+    print("  output events:           {0:8d}".format(len(events)))
+    print("  saved files:             {0:8d}".format(len(files)))
+    print("  reproducible:            {0:>8}".format(
+        'yes' if (events, files) == (events_again, files_again) else 'NO'))
+
+
+def benchmark_gui_idle(runs=200):
+    """Cost of one GUI timer tick with nothing changed: full redraw (as
+    before dirty tracking) vs refresh()."""
+    import tkinter
+    import midi_notebook_gui
+    from midi_notebook.midi_notebook_context import MidiNotebookContext
+    from midi_notebook.midi_notebook_virtual import VirtualMidiBackend
+
+    MidiNotebookContext.instance = None
+    context = MidiNotebookContext(dict(
+        midi_notebook_gui.CONFIGURATION, midi_backend=VirtualMidiBackend()))
+
+    try:
+        app = midi_notebook_gui.Application(context)
+    except tkinter.TclError as e:
+        print("gui_idle: skipped ({0})".format(e))
+        return
+
+    # a playing master loop and an idle slave
+    context.loops[0].duration = 4.0
+    context.loops[0].is_playback = True
+    app.refresh()
+
+    start = time.perf_counter()
+    for n in range(runs):
+        app.render_all()
+        app.root.update()
+    full = (time.perf_counter() - start) / runs
+
+    start = time.perf_counter()
+    for n in range(runs):
+        app.refresh()
+        app.root.update_idletasks()
+    idle = (time.perf_counter() - start) / runs
+
+    app.root.destroy()
+    MidiNotebookContext.instance = None
+
+    print("gui_idle ({0} ticks)".format(runs))
+    print("  full redraw:             {0:8.3f} ms".format(full * 1000))
+    print("  dirty-tracked refresh:   {0:8.3f} ms".format(idle * 1000))
+
+
+def generate_performance(minutes, bpm, beats_per_bar=4, seed=0):
+    """Eighth notes with human timing, accented bars and missed offbeats
+    (time_stamp = delta)."""
+    import random
+    from midi_notebook.midi_notebook_context import MidiMessage
+
+    rnd = random.Random(seed)
+    eighth = 30.0 / bpm
+    events = []
+    for n in range(int(minutes * 60 / eighth)):
+        on_beat = n % 2 == 0
+        if rnd.random() > (0.9 if on_beat else 0.4):
+            continue
+        velocity = 110 if n % (2 * beats_per_bar) == 0 else (80 if on_beat else 60)
+        note = rnd.randint(48, 72)
+        start = n * eighth + rnd.gauss(0, 0.01)
+        events.append((start, [144, note, velocity]))
+        events.append((start + eighth * 0.8, [128, note, 0]))
+    events.sort(key=lambda event: event[0])
+
+    messages = []
+    last_time = 0.0
+    for event_time, data in events:
+        messages.append(MidiMessage(data, max(event_time - last_time, 0)))
+        last_time = event_time
+    return messages
+
+
+def benchmark_tempo(minutes=60, bpm=97):
+    from midi_notebook.midi_notebook_tempo import onset_times, detect_tempo
+
+    messages = generate_performance(minutes, bpm, beats_per_bar=3)
+
+    start = time.perf_counter()
+    onsets, velocities = onset_times(messages)
+    extracted = time.perf_counter()
+    detected_bpm, beats_per_bar = detect_tempo(onsets, velocities)
+    end = time.perf_counter()
+
+    print("tempo ({0} minutes, {1} messages, {2} bpm in 3/4)".format(
+        minutes, len(messages), bpm))
+    print("  detected:                {0:8.2f} bpm, {1}/4".format(
+        detected_bpm, beats_per_bar))
+    print("  onset extraction:        {0:8.1f} ms".format(
+        (extracted - start) * 1000))
+    print("  detection:               {0:8.1f} ms".format(
+        (end - extracted) * 1000))
+    print("  total:                   {0:8.1f} ms".format((end - start) * 1000))
+
+
+BENCHMARKS = {
+    'gui_idle': benchmark_gui_idle,
+    'startup': benchmark_startup,
+    'simulation': benchmark_simulation,
+    'tempo': benchmark_tempo,
+}
+
+
+def main():
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark {0}: choose from {1}.".format(
+                name, ', '.join(sorted(BENCHMARKS))))
+            sys.exit(1)
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main()
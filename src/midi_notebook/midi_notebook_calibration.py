@@ -0,0 +1,87 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Output latency calibration.
+
+Each output port is wired back to one input port (a cable, a virtual port,
+or VirtualMidiBackend.loopback) and probe messages are timed on the round
+trip. The input side of the trip is the same for every port, so the
+differences between the measures are the differences between the outputs:
+the players delay the faster ports by them (see
+MidiNotebookContext.get_output_compensation).
+"""
+
+PROBE = [0x8F, 0, 0]  # note off, channel 16, note 0: harmless if it sounds
+POLL_INTERVAL = 0.0005  # seconds
+
+
+def measure_latency(context, output_port, input_port, probes=8, timeout=0.5):
+    """Median round trip (seconds) from output_port to input_port, None if
+    the probes do not come back."""
+    clock = context.clock
+    arrivals = []
+
+    def cb_probe(message, time_stamp):
+        if list(message) == PROBE:
+            arrivals.append(clock.time())
+
+    midi_in = context.midi_backend.MidiIn()
+    midi_in.callback = cb_probe
+    midi_in.open_port(input_port)
+
+    latencies = []
+    try:
+        for n in range(probes):
+            sent = clock.time()
+            context.output_pool.send_batch(output_port, [PROBE])
+            while len(arrivals) <= n and clock.time() - sent < timeout:
+                clock.sleep(POLL_INTERVAL)
+            if len(arrivals) <= n:
+                return None
+            latencies.append(arrivals[n] - sent)
+    finally:
+        midi_in.close_port()
+
+    latencies.sort()
+    return latencies[len(latencies) // 2]
+
+
+def calibrate(context, input_port, output_ports=None, probes=8):
+    """Measure the output ports (default: all) through the loopback
+    input_port and store the results in context.output_latency.
+
+    Recording is suspended meanwhile, so the probes do not end up in the
+    session.
+    """
+    if output_ports is None:
+        output_ports = range(len(context.get_output_ports()))
+
+    context.stop_recording()
+    try:
+        for port in output_ports:
+            latency = measure_latency(context, port, input_port, probes)
+            if latency is None:
+                context.write_message(
+                    "MIDI out port {0}: no loopback on MIDI in port {1}.".format(port, input_port))
+                continue
+
+            context.output_latency[port] = latency
+            context.write_message(
+                "MIDI out port {0}: {1:.1f} ms round trip.".format(port, latency * 1000))
+    finally:
+        context.start_recording()
+
+    return context.output_latency
@@ -0,0 +1,150 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Clocks: the context, loops and players take the time from one of these.
+
+RealClock is the wall clock. SimulatedClock jumps straight to the next
+deadline as soon as every thread of the simulation is sleeping or waiting,
+so a session runs as fast as the CPU allows, with exactly the nominal
+timings and in a reproducible order.
+
+Threads taking part in a simulation must be announced with add_thread()
+(before start) and remove_thread() (on exit), and must only block through
+the clock: sleep(), select(), or wait() on a Condition() made by the clock.
+"""
+
+import time
+import heapq
+import threading
+
+
+class RealClock():
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0))
+
+    def select(self, selector, seconds):
+        """selector.select(), waiting up to seconds for an event."""
+        return selector.select(max(seconds, 0))
+
+    def Condition(self):
+        return threading.Condition()
+
+    def add_thread(self):
+        pass
+
+    def remove_thread(self):
+        pass
+
+
+class SimulatedClock():
+
+    def __init__(self, start=None):
+        self._now = time.time() if start is None else start
+        self._lock = threading.Condition()
+        self._active = 1  # the thread driving the simulation
+        self._sleepers = []  # heap of (deadline, sequence, woken flag)
+        self._sequence = 0
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        with self._lock:
+            woken = [False]
+            heapq.heappush(self._sleepers, (
+                self._now + max(seconds, 0), self._sequence, woken))
+            self._sequence += 1
+            self._deactivate()
+            while not woken[0]:
+                self._lock.wait()
+
+    def select(self, selector, seconds):
+        # the events of the simulated interval are those pending after it
+        self.sleep(seconds)
+        return selector.select(0)
+
+    def Condition(self):
+        return SimulatedCondition(self)
+
+    def add_thread(self):
+        with self._lock:
+            self._active += 1
+
+    def remove_thread(self):
+        with self._lock:
+            self._deactivate()
+
+    def _deactivate(self):
+        # with self._lock held
+        self._active -= 1
+        if self._active > 0 or not self._sleepers:
+            return
+
+        # everybody is blocked: jump to the first deadline and wake only its
+        # sleeper, so that the order of events is reproducible
+        deadline, sequence, woken = heapq.heappop(self._sleepers)
+        self._now = max(self._now, deadline)
+        woken[0] = True
+        self._active += 1
+        self._lock.notify_all()
+
+
+class SimulatedCondition():
+
+    """threading.Condition counterpart for SimulatedClock threads."""
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    def acquire(self):
+        self._lock.acquire()
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def wait(self):
+        woken = [False]
+        self._waiters.append(woken)
+
+        with self._clock._lock:
+            self._clock._deactivate()
+        self._lock.release()
+
+        with self._clock._lock:
+            while not woken[0]:
+                self._clock._lock.wait()
+        self._lock.acquire()
+
+    def notify_all(self):
+        with self._clock._lock:
+            for woken in self._waiters:
+                woken[0] = True
+            self._clock._active += len(self._waiters)
+            self._waiters = []
+            self._clock._lock.notify_all()
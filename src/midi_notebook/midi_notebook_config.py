@@ -50,13 +50,36 @@ class Configuration():
             context.output_port = None
 
         for n in range(context.n_loops):
-            context.loop_toggle_message_signature[n] =\
+            context.set_loop_toggle_message_signature(
+                n,
                 [
                     config.getint(
                         'LOOP_MIDI_TRIGGERS', 'loop_{0}_ccn'.format(n)),
                     config.getint(
                         'LOOP_MIDI_TRIGGERS', 'loop_{0}_value'.format(n)),
-                ]
+                ])
+
+        if config.has_section('LOOP_OUTPUTS'):
+            for n in range(context.n_loops):
+                context.set_loop_output(
+                    n,
+                    self._get_optional_int(
+                        config, 'LOOP_OUTPUTS', 'loop_{0}_port'.format(n)),
+                    self._get_optional_int(
+                        config, 'LOOP_OUTPUTS', 'loop_{0}_channel'.format(n)))
+
+        if config.has_section('OUTPUT_LATENCY'):
+            for option in config.options('OUTPUT_LATENCY'):
+                port = int(option[len('port_'):])
+                context.output_latency[port] = config.getfloat(
+                    'OUTPUT_LATENCY', option)
+
+    @staticmethod
+    def _get_optional_int(config, section, option):
+        try:
+            return config.getint(section, option)
+        except ValueError:
+            return None
 
     def write(self, context):
         config = configparser.ConfigParser()
@@ -75,5 +98,17 @@ class Configuration():
             config['LOOP_MIDI_TRIGGERS'][
                 'loop_{0}_value'.format(n)] = str(signature[1])
 
+        config['LOOP_OUTPUTS'] = {}
+        for n in range(context.n_loops):
+            config['LOOP_OUTPUTS'][
+                'loop_{0}_port'.format(n)] = str(context.loop_output_ports[n])
+            config['LOOP_OUTPUTS'][
+                'loop_{0}_channel'.format(n)] = str(context.loop_output_channels[n])
+
+        config['OUTPUT_LATENCY'] = {}
+        for port, latency in sorted(context.output_latency.items()):
+            config['OUTPUT_LATENCY'][
+                'port_{0}'.format(port)] = repr(latency)
+
         with open(self.config_file_path, 'w') as config_file:
             config.write(config_file)
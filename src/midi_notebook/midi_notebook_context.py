@@ -14,14 +14,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import time
 import threading
-import datetime
 import os
 import sys
 
-import rtmidi_python as rtmidi
-from midiutil.MidiFile3 import MIDIFile
+from midi_notebook.midi_notebook_clock import RealClock
+from midi_notebook.midi_notebook_output import OutputPool
+from midi_notebook.midi_notebook_stats import SessionStatistics
+from midi_notebook.midi_notebook_transform import IDENTITY, TransformTables
+
+# rtmidi_python, midiutil and datetime are imported where they are first
+# needed, so that the GUI can be built while MIDI ports are being scanned.
 
 
 class MidiEventTypes():
@@ -30,13 +33,17 @@ class MidiEventTypes():
     CONTROL_CHANGE = 176
 
 
+_UNSET = object()
+
+
 class MidiMessage:
 
     N_MIDI_CHANNELS = 16
 
-    def __init__(self, data, time_stamp):
+    def __init__(self, data, time_stamp, loop_index=None):
         self._data = data
         self.time_stamp = time_stamp
+        self.loop_index = loop_index  # None = live input
 
     def __len__(self):
         return len(self._data)
@@ -51,7 +58,7 @@ class MidiMessage:
         return "{0}, {1:.2f}".format(str(self._data)[1:-1], self.time_stamp)
 
     def clone(self):
-        return MidiMessage(self._data[:], self.time_stamp)
+        return MidiMessage(self._data[:], self.time_stamp, self.loop_index)
 
     @property
     def type(self):
@@ -73,9 +80,29 @@ class MidiMessage:
 
 class Loop():
 
-    def __init__(self):
+    # assigning a new value to one of these bumps version (see __setattr__)
+    STATE_ATTRIBUTES = frozenset([
+        'is_playback', 'is_recording', 'start_recording_time', 'duration',
+        'waiting_for_sync'])
+
+    def __init__(self, clock, on_state_change=None, on_take=None):
+        self.clock = clock
+        self.version = 0
+        self.take_version = 0  # bumped at each new recording
+        self.on_state_change = on_state_change  # function(loop)
+        self.on_take = on_take  # function(loop), when a take is frozen
+        self.transform = None  # LoopTransform of the playback, None = as recorded
         self.clean()
 
+    def __setattr__(self, name, value):
+        changed = name in self.STATE_ATTRIBUTES and \
+            self.__dict__.get(name, _UNSET) != value
+        object.__setattr__(self, name, value)
+        if changed:
+            self.version += 1
+            if self.on_state_change is not None:
+                self.on_state_change(self)
+
     def clean(self):
         self.is_playback = False
         self.is_recording = False
@@ -105,6 +132,7 @@ class Loop():
         return len(self.messages_captured) >= 2
 
     def start_recording(self):
+        self.take_version += 1
         self.is_playback = False
         self.is_recording = True
         self.start_recording_time = None
@@ -118,11 +146,64 @@ class Loop():
         self.is_recording = False
         self.duration = None
         if self.start_recording_time is not None:
-            self.duration = time.time() - self.start_recording_time
+            self.duration = self.clock.time() - self.start_recording_time
+            if self.on_take is not None and self.is_playable:
+                self.on_take(self)
+
+
+class LoopbackReference():
+
+    """Messages start to end of a loop take, played in the cycle started at
+    cycle_start: the session keeps these instead of a copy of every message
+    played, and expands them at export time."""
+
+    def __init__(self, loop_index, take_version, cycle_start, take, offsets, start,
+                 tables=None, sounding=None):
+        self.loop_index = loop_index
+        self.take_version = take_version
+        self.cycle_start = cycle_start
+        self.take = take  # messages of the take
+        self.tables = tables  # TransformTables played through, None = as recorded
+        # TransformTables.new_sounding() of the player, shared by its
+        # references: expanded in order, their note offs pair as played
+        self.sounding = sounding
+        self.offsets = offsets  # seconds from cycle_start, per message
+        self.start = start
+        self.end = start
+        self.is_open = True  # the player may still extend it
+
+    def split(self):
+        """Detach the messages played so far: returns them as a new
+        reference, and keeps only the following ones."""
+        end = self.end
+        played = LoopbackReference(self.loop_index, self.take_version,
+                                   self.cycle_start, self.take, self.offsets,
+                                   self.start, self.tables, self.sounding)
+        played.end = end
+        played.is_open = False
+        self.start = end
+        return played
+
+    def expand(self):
+        """-> [(absolute time, message)]"""
+        result = []
+        for n in range(self.start, self.end):
+            if self.tables is None:
+                message = self.take[n].clone()
+            else:
+                message = self.tables.transform_message(self.take[n], self.sounding)
+                if message is None:
+                    continue  # filtered out
+            message.loop_index = self.loop_index
+            result.append((self.cycle_start + self.offsets[n], message))
+        return result
 
 
 class LoopPlayer(threading.Thread):
 
+    # messages closer than this (seconds) are sent together
+    BATCH_WINDOW = 0.001
+
     def __init__(self, context, n):
         super().__init__()
         self.context = context
@@ -130,12 +211,15 @@ class LoopPlayer(threading.Thread):
         self.loop_index = n
         self.is_master_loop = n == 0
         self.force_exit_activated = False
+        self.reference = None  # LoopbackReference being played
 
     def run(self):
         try:
             self.run_unsafe()
         except Exception:
             sys.excepthook(*sys.exc_info())
+        finally:
+            self.context.clock.remove_thread()
 
     def run_unsafe(self):
         # avoid concurrency
@@ -147,6 +231,8 @@ class LoopPlayer(threading.Thread):
             self.context.write_message("NOTHING TO PLAY. :-(")
             return
 
+        take_version = self.loop.take_version
+
         if loop_sync_delay is None or not self.context.is_sync_active:
             loop_messages_captured[0].time_stamp = 0
             self.loop.waiting_for_sync = False
@@ -154,18 +240,43 @@ class LoopPlayer(threading.Thread):
             loop_messages_captured[0].time_stamp = loop_sync_delay
             self.loop.waiting_for_sync = True
 
-        if self.context.midi_out is None:
-            if self.context.output_port is None:
-                self.context.write_message("Please select a MIDI output port.")
-                return
-
-            self.context.midi_out = rtmidi.MidiOut()
-            self.context.midi_out.open_port(self.context.output_port)
+        # nominal time of each message from the start of the cycle
+        offsets = []
+        offset = 0.0
+        for m in loop_messages_captured:
+            offset += float(m.time_stamp)
+            offsets.append(offset)
+
+        # messages due (nearly) together are sent as one batch, spanning
+        # at most BATCH_WINDOW:
+        # [delay from the previous batch, first message, last message + 1]
+        batches = []
+        for n, m in enumerate(loop_messages_captured):
+            if batches and offsets[n] - offsets[batches[-1][1]] <= self.BATCH_WINDOW:
+                batches[-1][2] = n + 1
+            else:
+                delay = offsets[n] - (offsets[batches[-1][1]] if batches else 0)
+                batches.append([delay, n, n + 1])
+
+        tail_time = loop_duration + offsets[0] - offsets[batches[-1][1]]
+
+        # the take is sent through the tables of the loop transform and
+        # channel (identity if none), into buffers allocated once; the
+        # sounding notes are always tracked, so that note offs follow their
+        # note ons across transform changes, also when exported
+        self.take = loop_messages_captured
+        self.take_version = take_version
+        self.offsets = offsets
+        self.tables = None
+        self.tables_key = None  # (transform, channel) of tables
+        self.buffers, self.outgoing = TransformTables.new_buffers(loop_messages_captured)
+        self.sounding = TransformTables.new_sounding()
+        self.export_sounding = TransformTables.new_sounding()
 
         while (True):
             self.context.loop_sync.acquire()
             if (self.is_master_loop):
-                self.context.last_loop_sync = time.time()
+                self.context.last_loop_sync = self.context.clock.time()
                 self.context.loop_sync.notify_all()
             else:
                 if self.context.is_sync_active:
@@ -174,26 +285,78 @@ class LoopPlayer(threading.Thread):
 
             self.context.loop_sync.release()
 
-            total_time = sum(float(m.time_stamp)
-                             for m in loop_messages_captured[1:])
-
-            for m in loop_messages_captured:
+            self.cycle_start = self.context.clock.time()
+            self.reference = None  # loopback recording of this cycle
 
-                if not self.loop.is_playback:
-                    if not self.is_master_loop:
-                        return  # master loop is never ended, only muted
-
-                if self.force_exit_activated:
-                    return
+            # routing changes apply from the next cycle
+            port = self.context.get_loop_output_port(self.loop_index)
+            if port is None:
+                self.context.write_message("Please select a MIDI output port.")
+                return
 
-                time.sleep(float(m.time_stamp))
+            channel = self.context.loop_output_channels[self.loop_index]
 
-                if self.loop.is_playback:
-                    self.context.midi_out.send_message(m)
-                    self.context.capture_message(
-                        m, loop_index=self.loop_index)  # loopback!
+            # faster ports wait for the slowest one; taken from the tail, so
+            # the player is back in time for the next sync
+            compensation = min(
+                self.context.get_output_compensation(port), tail_time)
+            if compensation > 0:
+                self.context.clock.sleep(compensation)
 
-            time.sleep(loop_duration - total_time)
+            try:
+                for delay, start, end in batches:
+
+                    if not self.loop.is_playback:
+                        if not self.is_master_loop:
+                            return  # master loop is never ended, only muted
+
+                    if self.force_exit_activated:
+                        return
+
+                    self.context.clock.sleep(delay)
+
+                    if self.loop.is_playback:
+                        self.play_batch(port, channel, start, end)
+                    else:
+                        self.close_reference()  # muted
+            finally:
+                self.close_reference()
+
+            self.context.clock.sleep(tail_time - compensation)
+
+    def play_batch(self, port, channel, start, end):
+        """Send messages start:end of the take and add them to the loopback
+        reference of the cycle."""
+        # transform swaps apply from the next batch
+        transform = self.loop.transform
+        if (transform, channel) != self.tables_key:
+            self.tables_key = (transform, channel)
+            self.tables = (transform or IDENTITY).tables(channel)
+            self.close_reference()
+
+        self.tables.apply(self.take, start, end,
+                          self.buffers, self.outgoing, self.sounding)
+
+        self.context.output_pool.send_batch(port, self.outgoing, start, end)
+        self.context.stats.add_batch(
+            self.outgoing, start, end, self.context.clock.time(), self.loop_index)
+
+        # loopback!
+        if self.reference is None:
+            self.reference = self.context.add_loopback_reference(
+                LoopbackReference(self.loop_index, self.take_version, self.cycle_start,
+                                  self.take, self.offsets, start,
+                                  self.tables, self.export_sounding))
+        self.reference.end = end
+
+        if self.context.monitor:
+            for n in range(start, end):
+                self.context.write_midi_message(self.take[n], self.loop_index, False)
+
+    def close_reference(self):
+        if self.reference is not None:
+            self.reference.is_open = False
+            self.reference = None
 
     def force_exit(self):
         self.force_exit_activated = True
@@ -210,35 +373,98 @@ class MetaSingleton(type):
 
 class MidiNotebookContext(metaclass=MetaSingleton):
 
+    TEMPO_DETECTION_MODES = ('loop', 'session')
+
     def __init__(self, configuration):
 
         self.long_pause = configuration['long_pause']
         self.midi_file_name = configuration['midi_file_name']
+        # archive of the raw session, for re-export (None = no archive)
+        self.session_file_name = configuration.get('session_file_name', None)
+        # add each saved MIDI file to the output_dir search index
+        self.index_midi_files = configuration.get('index_midi_files', False)
+        self.output_dir = configuration.get(
+            'output_dir', os.path.dirname(sys.argv[0]))
         self.bpm = configuration['bpm']
         self.monitor = configuration['monitor']
         self.write_message_function = configuration.get(
             'write_message_function', None)
         self.loop_toggle_message_signature = configuration[
             'loop_toggle_message_signature']
-
-        self.last_event = time.time()
-        self.messages_captured = []
+        # quantization of loop takes and exports (grid in beats, None = off)
+        self.quantize_grid = configuration.get('quantize_grid', None)
+        self.quantize_strength = configuration.get('quantize_strength', 1.0)
+        self.quantize_swing = configuration.get('quantize_swing', 0.0)
+        # tempo of the MIDI files detected from the master loop ('loop', or
+        # the session if there is none) or the session ('session'); None =
+        # bpm as configured
+        self.tempo_detection = configuration.get('tempo_detection', None)
+        self.detected_tempo = None  # (bpm, beats per bar) of the last save
+
+        # time source: RealClock, or SimulatedClock for faster than real time
+        self.clock = configuration.get('clock', None)
+        if self.clock is None:
+            self.clock = RealClock()
+
+        self.last_event = self.clock.time()
+        self.messages_captured = []  # live input, time_stamp = delta
+        self.session_start = None  # time of messages_captured[0]
+        self.loopback_captured = []  # LoopbackReference
+        self.loopback_lock = threading.Lock()
+        self.last_loopback_event = self.last_event
         self.midi_in_ports = []
         self.input_port = None
         self._output_port = None
-        self.midi_out = None
+        self._input_ports = None
+        self._output_ports = None
+        self._ports_scanned = None
+        self.output_pool = OutputPool(self)
+        self.profiler = None
+        # localhost UDP port for loop commands (None = no control server)
+        self.control_port = configuration.get('control_port', None)
+        self.control_server = None
+        # rtmidi_python-compatible MidiIn/MidiOut factory (None = rtmidi_python)
+        self._midi_backend = configuration.get('midi_backend', None)
 
         self.n_loops = 4
-        self.loops = [Loop() for n in range(self.n_loops)]
+
+        # per loop output port and channel (None = output_port / as recorded)
+        self.loop_output_ports = list(configuration.get(
+            'loop_output_ports', [None for n in range(self.n_loops)]))
+        self.loop_output_channels = list(configuration.get(
+            'loop_output_channels', [None for n in range(self.n_loops)]))
+
+        # output port -> calibrated round trip latency (seconds)
+        self.output_latency = dict(configuration.get('output_latency', {}))
+
+        # bumped on every loop state or signature change: the GUI redraws
+        # only when it moves
+        self.state_version = 0
+        self.signature_version = 0
+        self.loops = [Loop(self.clock, self.loop_state_changed, self.quantize_take)
+                      for n in range(self.n_loops)]
+        # tables are compiled before a player needs them, never in its
+        # send path: here, and when the channel or transform changes
+        for channel in set(self.loop_output_channels):
+            IDENTITY.tables(channel)
+
+        self.stats = SessionStatistics(self.n_loops)
+        # seconds between statistics on the monitor (None = never)
+        self.stats_interval = configuration.get('stats_interval', None)
+        self.last_stats = self.last_event
+        self.printed_stats_version = None
         self.last_toggle_loop = [0 for n in range(self.n_loops)]
 
-        self.loop_sync = threading.Condition()
+        self.loop_sync = self.clock.Condition()
         self.last_loop_sync = None
         self.loop_threads = [None for n in range(self.n_loops)]
 
     def clean_all(self):
-        self.last_event = time.time()
+        self.last_event = self.clock.time()
         self.messages_captured = []
+        self.session_start = None
+        with self.loopback_lock:
+            self.loopback_captured = []
 
         for n, l in enumerate(self.loops):
             self.clean_loop(n)
@@ -247,9 +473,68 @@ class MidiNotebookContext(metaclass=MetaSingleton):
                 self.loop_threads[n] = None
 
         self.last_toggle_loop = [0 for n in range(self.n_loops)]
-        self.loop_sync = threading.Condition()
+        self.loop_sync = self.clock.Condition()
         self.last_loop_sync = None
         self.loop_threads = [None for n in range(self.n_loops)]
+        self.stats.reset()
+
+    def loop_state_changed(self, loop):
+        self.state_version += 1
+
+    def get_beat_length(self):
+        """Seconds per beat: from bpm, stretched so that the master loop
+        lasts a whole number of beats."""
+        beat_length = 60.0 / self.bpm
+        master_duration = self.loops[0].duration
+        if master_duration is not None:
+            beat_length = master_duration / \
+                max(1, round(master_duration / beat_length))
+        return beat_length
+
+    def get_export_bpm(self, messages):
+        if self.tempo_detection is None:
+            return self.bpm
+        from midi_notebook.midi_notebook_tempo import onset_times, detect_tempo
+
+        tempo = None
+        master = self.loops[0]
+        master_duration = master.duration
+        if self.tempo_detection == 'loop' and master_duration is not None:
+            onsets, velocities = onset_times(master.messages_captured)
+            tempo = detect_tempo(onsets, velocities, master_duration)
+        if tempo is None:
+            onsets, velocities = onset_times(messages)
+            tempo = detect_tempo(onsets, velocities)
+        if tempo is None:
+            self.write_message(
+                "Tempo not detected: using {0} bpm.".format(self.bpm))
+            return self.bpm
+
+        self.detected_tempo = (float(tempo[0]), tempo[1])
+        self.write_message("Detected tempo: {0:.1f} bpm, {1} beats per bar.".format(
+            *self.detected_tempo))
+        return self.detected_tempo[0]
+
+    def quantize_take(self, loop):
+        if self.quantize_grid is None:
+            return
+        from midi_notebook.midi_notebook_quantize import quantize_messages
+
+        # slave takes are on the grid of the master cycle
+        first_time = 0.0 if loop.sync_delay is None else loop.sync_delay
+        messages = quantize_messages(
+            loop.messages_captured, self.quantize_grid * self.get_beat_length(),
+            self.quantize_strength, self.quantize_swing,
+            first_time, first_time + loop.duration)
+
+        if loop.sync_delay is not None:
+            loop.sync_delay = messages[0].time_stamp
+        loop.messages_captured = messages
+
+    def set_loop_toggle_message_signature(self, n, signature):
+        self.loop_toggle_message_signature[n] = signature
+        self.signature_version += 1
+        self.state_version += 1
 
     @property
     def is_sync_active(self):
@@ -265,7 +550,7 @@ class MidiNotebookContext(metaclass=MetaSingleton):
         for n in range(self.n_loops):
             if n == position:
                 result += (' {0}{1:<19}|'.format('*' if recording else ' ',
-                           message))
+                           str(message)))
             else:
                 result += ('  {0:<19}|'.format(''))
 
@@ -300,23 +585,67 @@ class MidiNotebookContext(metaclass=MetaSingleton):
 
         if show_usage:
             self.write_message(
-                "Usage: {0} [-inPORT] [-outPORT]".format(os.path.basename(sys.argv[0])))
+                "Usage: {0} [-inPORT] [-outPORT] [-controlPORT] [-quantizeGRID] [-tempoloop|-temposession] [--profile[=sampling|timers]]".format(os.path.basename(sys.argv[0])))
             self.write_message(
                 "-inPORT: Record only from the specified port (default: ALL).")
             self.write_message(
                 "-outPORT: Port for playback/loop (default: NONE).")
+            self.write_message(
+                "-controlPORT: Accept loop commands on this localhost UDP port (default: NONE).")
+            self.write_message(
+                "-quantizeGRID: Quantize loops and MIDI files to GRID beats, e.g. 0.25 (default: NONE).")
+            self.write_message(
+                "-tempoloop, -temposession: Detect the tempo of MIDI files from the master loop or the session (default: bpm).")
+            self.write_message(
+                "--profile: Write a flamegraph profile on exit (default mode: sampling).")
 
         self.write_message("")
 
+    @property
+    def midi_backend(self):
+        if self._midi_backend is None:
+            import rtmidi_python
+            self._midi_backend = rtmidi_python
+        return self._midi_backend
+
+    def scan_ports(self):
+        """Enumerate MIDI ports once, in a background thread.
+
+        get_input_ports() and get_output_ports() wait for the scan to finish
+        (and start it if nobody did).
+        """
+        if self._ports_scanned is not None:
+            return
+
+        self._ports_scanned = threading.Event()
+        scanner = threading.Thread(target=self._scan_ports)
+        scanner.daemon = True
+        scanner.start()
+
+    def _scan_ports(self):
+        try:
+            self._input_ports = self.midi_backend.MidiIn().ports
+            self._output_ports = self.midi_backend.MidiOut().ports
+        finally:
+            self._ports_scanned.set()
+
+        # validate a port selected before the scan was completed
+        if self._output_port is not None and self._output_port >= len(self._output_ports):
+            self.output_port = None
+
+    @property
+    def is_port_scan_completed(self):
+        return self._ports_scanned is not None and self._ports_scanned.is_set()
+
     def get_input_ports(self):
-        midi_in = rtmidi.MidiIn()
-        ports = midi_in.ports
-        return ports
+        self.scan_ports()
+        self._ports_scanned.wait()
+        return self._input_ports or []
 
     def get_output_ports(self):
-        midi_out = rtmidi.MidiOut()
-        ports = midi_out.ports
-        return ports
+        self.scan_ports()
+        self._ports_scanned.wait()
+        return self._output_ports or []
 
     @property
     def output_port(self):
@@ -326,7 +655,8 @@ class MidiNotebookContext(metaclass=MetaSingleton):
     def output_port(self, value):
         self.write_message("Setting MIDI output port to {0}.".format(value))
 
-        if value is not None and value >= len(self.get_output_ports()):
+        # before the end of the port scan, _scan_ports() validates the value
+        if value is not None and self.is_port_scan_completed and value >= len(self.get_output_ports()):
             self.write_message(
                 "MIDI out port {0} is invalid: stoppung output.".format(value))
             value = None
@@ -337,9 +667,63 @@ class MidiNotebookContext(metaclass=MetaSingleton):
                 self.stop_loop(n)
 
         self._output_port = value
-        if self.midi_out is not None:
-            self.midi_out.close_port()
-            self.midi_out = None
+        self.output_pool.close_all()
+
+    @property
+    def quantize_grid(self):
+        return self._quantize_grid
+
+    @quantize_grid.setter
+    def quantize_grid(self, value):
+        if value is not None:
+            from midi_notebook.midi_notebook_quantize import preload
+            preload()  # not when the first take is frozen, on the input thread
+        self._quantize_grid = value
+
+    @property
+    def tempo_detection(self):
+        return self._tempo_detection
+
+    @tempo_detection.setter
+    def tempo_detection(self, value):
+        if value is not None:
+            from midi_notebook.midi_notebook_tempo import preload
+            preload()
+        self._tempo_detection = value
+
+    def get_loop_output_port(self, n):
+        if self.loop_output_ports[n] is not None:
+            return self.loop_output_ports[n]
+        return self.output_port
+
+    def set_loop_output(self, n, port, channel):
+        """Route loop n to port (None = output_port) and channel (None = as
+        recorded), from its next cycle."""
+        if port is not None and self.is_port_scan_completed and port >= len(self.get_output_ports()):
+            self.write_message(
+                "MIDI out port {0} is invalid: using the default output.".format(port))
+            port = None
+
+        (self.loops[n].transform or IDENTITY).tables(channel)
+        self.loop_output_ports[n] = port
+        self.loop_output_channels[n] = channel
+
+    def set_loop_transform(self, n, transform):
+        """Play loop n through a LoopTransform (None = as recorded), from
+        its next event."""
+        (transform or IDENTITY).tables(self.loop_output_channels[n])
+        self.loops[n].transform = transform  # the player swaps ready tables
+
+    def get_output_compensation(self, port):
+        """Delay (seconds) for events sent to port, so that they sound
+        together with those sent to the slowest port of a playing loop."""
+        if port not in self.output_latency:
+            return 0.0
+
+        latencies = [self.output_latency[p] for p in set(
+            self.get_loop_output_port(n) for n in range(self.n_loops)
+            if self.loops[n].is_playback) if p in self.output_latency]
+        return max(latencies + [self.output_latency[port]]) - self.output_latency[port]
 
     def start_recording(self):
         if self.input_port is not None:
@@ -355,11 +739,16 @@ class MidiNotebookContext(metaclass=MetaSingleton):
                 self._start_recording_from_port(n)
 
     def _start_recording_from_port(self, input_port):
-        midi_in = rtmidi.MidiIn()
+        midi_in = self.midi_backend.MidiIn()
         midi_in.callback = self.capture_message_raw
         midi_in.open_port(input_port)
         self.midi_in_ports.append(midi_in)
 
+    def stop_recording(self):
+        for midi_in in self.midi_in_ports:
+            midi_in.close_port()
+        self.midi_in_ports = []
+
     def start_loop_recording(self, n):
 
         # one loop a time
@@ -392,6 +781,7 @@ class MidiNotebookContext(metaclass=MetaSingleton):
         if not need_resume_master_loop:
             player = LoopPlayer(self, n)
             player.daemon = True
+            self.clock.add_thread()
             player.start()
             if not self.loop_threads[n] is None:
                 self.loop_threads[n].force_exit()
@@ -406,12 +796,12 @@ class MidiNotebookContext(metaclass=MetaSingleton):
             self.last_loop_sync = None  # stop sync
 
     def toggle_loop(self, n):
-        if time.time() - self.last_toggle_loop[n] < 0.5:  # double tap/click
+        if self.clock.time() - self.last_toggle_loop[n] < 0.5:  # double tap/click
             self.clean_loop(n)
             self.start_loop_recording(n)
             return
 
-        self.last_toggle_loop[n] = time.time()
+        self.last_toggle_loop[n] = self.clock.time()
 
         if self.loops[n].is_playback:
             self.stop_loop(n)
@@ -439,7 +829,7 @@ class MidiNotebookContext(metaclass=MetaSingleton):
         message = MidiMessage(message_raw, time_stamp)
         self.capture_message(message)
 
-    def capture_message(self, message, loop_index=None):
+    def capture_message(self, message):
 
         for n in range(len(self.loop_toggle_message_signature)):
             if self.check_loop_toggle_message_signature(message, n):
@@ -448,33 +838,36 @@ class MidiNotebookContext(metaclass=MetaSingleton):
 
         message_for_midi_export = message.clone()
 
-        # adjusting loopback messages timing
-        message_for_midi_export.time_stamp = time.time() - self.last_event
+        # adjusting messages timing
+        message_for_midi_export.time_stamp = self.clock.time() - self.last_event
 
         if len(self.messages_captured) == 0:
             message.time_stamp = 0
             message_for_midi_export.time_stamp = 0
+            self.session_start = self.clock.time()
 
-        self.last_event = time.time()
+        self.last_event = self.clock.time()
 
         self.messages_captured.append(message_for_midi_export)
+        self.stats.add(message, self.last_event)
 
         if self.monitor:
             message_position = 0
-            if loop_index is not None:
-                message_position = loop_index
-            else:
-                for n in range(self.n_loops):
-                    if self.loops[n].is_recording:
-                        message_position = n
+            for n in range(self.n_loops):
+                if self.loops[n].is_recording:
+                    message_position = n
 
-            self.write_midi_message(
-                message, message_position, loop_index is None)
+            self.write_midi_message(message, message_position, True)
 
         for n in range(self.n_loops):
-            if loop_index is None and self.loops[n].is_recording:
+            if self.loops[n].is_recording:
                 self.handle_message_loop(message, n)
 
+    def add_loopback_reference(self, reference):
+        with self.loopback_lock:
+            self.loopback_captured.append(reference)
+        return reference
+
     def handle_message_loop(self, message, n):
         if self.loops[n].start_recording_time is None:
             if message.type != MidiEventTypes.NOTE_ON:
@@ -485,86 +878,134 @@ class MidiNotebookContext(metaclass=MetaSingleton):
                     self.last_loop_sync
 
         self.loops[n].messages_captured.append(message)
+        self.stats.add_recorded(n)
+
+    def get_last_loopback_event(self):
+        with self.loopback_lock:
+            for r in self.loopback_captured:
+                if r.end > r.start:
+                    self.last_loopback_event = max(
+                        self.last_loopback_event, r.cycle_start + r.offsets[r.end - 1])
+        return self.last_loopback_event
 
     def is_time_to_save(self):
         if self.long_pause is None:
             return False  # no autosave
-        return time.time() - self.last_event > self.long_pause
+        last_event = max(self.last_event, self.get_last_loopback_event())
+        return self.clock.time() - last_event > self.long_pause
+
+    def is_time_to_print_stats(self):
+        if self.stats_interval is None or not self.monitor:
+            return False
+        if self.stats.update() == self.printed_stats_version:
+            return False  # nothing new
+        return self.clock.time() - self.last_stats >= self.stats_interval
+
+    def take_session_messages(self):
+        """Live and loopback messages captured since the last call, merged
+        in time order (time_stamp = delta)."""
+        live_messages = self.messages_captured
+        session_start = self.session_start
+        self.messages_captured = []
+        self.session_start = None
+
+        self.get_last_loopback_event()  # before references are dropped
+        with self.loopback_lock:
+            references = self.loopback_captured
+            self.loopback_captured = [r for r in references if r.is_open]
+            played = [r.split() for r in references]
+
+        events = []
+        event_time = session_start
+        for message in live_messages:
+            event_time += message.time_stamp
+            events.append((event_time, message))
+        for reference in played:
+            events.extend(reference.expand())
+
+        # simultaneous events (to the microsecond, ignoring rounding errors):
+        # live input first, then by loop
+        events.sort(key=lambda event: (
+            round(event[0], 6), -1 if event[1].loop_index is None else event[1].loop_index))
+
+        messages = []
+        last_time = None
+        for event_time, message in events:
+            message = message.clone()
+            message.time_stamp = 0 if last_time is None else event_time - last_time
+            last_time = event_time
+            messages.append(message)
+
+        return messages
 
     def save_midi_file(self):
-        if len(self.messages_captured) == 0:
+        if len(self.messages_captured) == 0 and \
+                not any(r.end > r.start for r in self.loopback_captured):
             return
 
-        my_midi = MIDIFile(2)
-        track = 0
-
-        my_midi.addTrackName(track, 0, "Tempo track")
-        my_midi.addTempo(track, 0, self.bpm)
-
-        track += 1
-        my_midi.addTrackName(track, 0, "Song track")
-
-        total_time = 0
-        midi_messages_on = []
-        midi_messages_off = []
-        midi_messages_controller = []
-
-        for message in self.messages_captured:
-            if len(message) != 3:
-                self.write_message("wrong length: skipping " + str(message))
-                continue
-
-            total_time += message.time_stamp
-            # seconds -> beat conversion
-            total_time_adjusted = total_time * float(self.bpm) / float(60)
-
-            if message.type == MidiEventTypes.NOTE_ON:
-                midi_messages_on.append(
-                    {'note': message[1], 'velocity': message[2], 'time': total_time_adjusted, 'channel': message.channel})
-            elif message.type == MidiEventTypes.NOTE_OFF:
-                midi_messages_off.append(
-                    {'note': message[1], 'velocity': message[2], 'time': total_time_adjusted, 'channel': message.channel})
-            elif message.type == MidiEventTypes.CONTROL_CHANGE:
-                midi_messages_controller.append(
-                    {'type': message[1], 'value': message[2], 'time': total_time_adjusted, 'channel': message.channel})
-            else:
-                self.write_message("unknown message: skipping " + str(message))
-                continue
-
-        for m_on in midi_messages_on:
-            for m_off in midi_messages_off:
-                if m_off['note'] == m_on['note'] and m_off['time'] > m_on['time']:
-                    m_on['duration'] = m_off['time'] - m_on['time']
-                    m_off['note'] = -1
-                    break
-            else:
-                m_on['duration'] = float(
-                    15) * float(self.bpm) / float(60)  # suspended
+        import datetime
+        from midi_notebook import midi_notebook_export
 
-        for m in midi_messages_on:
-            my_midi.addNote(
-                track, m['channel'], m['note'], m['time'], m['duration'], m['velocity'])
+        messages = self.take_session_messages()
+        bpm = self.get_export_bpm(messages)
 
-        for m in midi_messages_controller:
-            my_midi.addControllerEvent(
-                track, m['channel'], m['time'], m['type'], m['value'])
+        export_messages = messages
+        quantize = None
+        if self.quantize_grid is not None:
+            quantize = (self.quantize_grid, self.quantize_strength, self.quantize_swing)
+            from midi_notebook.midi_notebook_quantize import quantize_messages
+            export_messages = quantize_messages(
+                messages, self.quantize_grid * 60.0 / bpm,
+                self.quantize_strength, self.quantize_swing)
 
-        file_name = self.midi_file_name.format(
-            datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
-        file_path = os.path.join(os.path.dirname(sys.argv[0]), file_name)
+        my_midi = midi_notebook_export.build_midi_file(
+            export_messages, bpm, write_message=self.write_message)
+
+        now = datetime.datetime.fromtimestamp(
+            self.clock.time()).strftime("%Y%m%d-%H%M%S")
+        file_name = self.midi_file_name.format(now)
+        file_path = os.path.join(self.output_dir, file_name)
         self.write_message("Saving {0} MIDI messages to {1}...".format(
-            len(self.messages_captured), file_name))
-        binfile = open(file_path, 'wb')
-        my_midi.writeFile(binfile)
-        binfile.close()
-        self.messages_captured = []
+            len(messages), file_name))
+        midi_notebook_export.write_midi_file(my_midi, file_path)
+
+        if self.session_file_name is not None:
+            midi_notebook_export.write_session(
+                os.path.join(self.output_dir, self.session_file_name.format(now)),
+                messages, bpm, quantize)
+
+        if self.index_midi_files:
+            from midi_notebook.midi_notebook_index import add_to_journal
+            try:
+                add_to_journal(file_path)
+            except (IOError, ValueError) as e:
+                # the search indexes it later
+                self.write_message("{0} not indexed: {1}".format(file_name, e))
+
         self.write_message("Saved.")
 
+    def start_control_server(self):
+        if self.control_port is None or self.control_server is not None:
+            return
+        from midi_notebook.midi_notebook_control import ControlServer
+        self.control_server = ControlServer(self, self.control_port)
+        self.control_server.open()
+
     def start_main_loop(self):
+        self.start_control_server()
         while (True):
             try:
-                time.sleep(1)
+                if self.control_server is not None:
+                    self.control_server.poll(1)  # commands run here
+                else:
+                    self.clock.sleep(1)
                 if (self.is_time_to_save()):
                     self.save_midi_file()
+                if self.is_time_to_print_stats():
+                    self.last_stats = self.clock.time()
+                    self.write_message(self.stats.summary(self.last_stats))
+                    self.printed_stats_version = self.stats.summary_version
+                else:
+                    self.stats.update()  # the capture path only queues
             except IOError:
                 pass
@@ -0,0 +1,240 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local UDP control of the looper, for show-control systems.
+
+Each datagram is one command, either as text ("/loop/toggle 2") or as an
+OSC message (address "/loop/toggle", int argument 2). Every command gets a
+text reply: "ok COMMAND LATENCY_MS" or "error MESSAGE".
+
+LATENCY_MS runs from the datagram read to the end of the action: the time a
+command waits in the socket before the main loop reads it (at most one poll,
+longer while a MIDI file is being saved) is not included. The client round
+trip covers it.
+
+Client usage (from the src directory):
+python -m midi_notebook.midi_notebook_control PORT COMMAND [LOOP]
+"""
+
+import sys
+import time
+import socket
+import struct
+import selectors
+
+
+class ControlServer():
+
+    HOST = '127.0.0.1'  # local only
+
+    # address -> (context method, takes a loop index)
+    COMMANDS = {
+        '/loop/toggle': ('toggle_loop', True),
+        '/loop/play': ('play_loop', True),
+        '/loop/stop': ('stop_loop', True),
+        '/clean_all': ('clean_all', False),
+        '/save': ('save_midi_file', False),
+    }
+
+    def __init__(self, context, port):
+        self.context = context
+        self.port = port
+        self.socket = None
+        self.selector = None
+
+        # command-to-action latency, from the datagram read to the end of
+        # the context call (time queued in the socket excluded)
+        self.n_commands = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def open(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind((self.HOST, self.port))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.context.write_message(
+            "Listening for commands on udp://{0}:{1}.".format(self.HOST, self.port))
+
+    def close(self):
+        if self.socket is None:
+            return
+        self.selector.close()
+        self.socket.close()
+        self.selector = None
+        self.socket = None
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds, handling the commands received."""
+        if not self.context.clock.select(self.selector, timeout):
+            return
+
+        while True:
+            try:
+                data, address = self.socket.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # e.g. ICMP port unreachable for a previous reply
+
+            received = time.perf_counter()
+            reply = self.handle(data, received)
+            try:
+                self.socket.sendto(reply.encode('utf-8'), address)
+            except OSError:
+                pass
+
+    def handle(self, data, received):
+        try:
+            command, args = self.parse(data)
+        except ValueError as e:
+            return "error {0}".format(e)
+
+        if command == '/latency':
+            return "ok /latency {0}".format(self.latency_report())
+
+        if command not in self.COMMANDS:
+            return "error unknown command {0}".format(command)
+
+        method_name, takes_loop = self.COMMANDS[command]
+        method = getattr(self.context, method_name)
+        if takes_loop:
+            n = _parse_loop(args, self.context.n_loops)
+            if n is None:
+                return "error {0} needs a loop number (0-{1})".format(
+                    command, self.context.n_loops - 1)
+            method(n)
+        else:
+            method()
+
+        latency = time.perf_counter() - received
+        self.n_commands += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+        return "ok {0} {1:.3f}".format(command, latency * 1000)
+
+    def latency_report(self):
+        if self.n_commands == 0:
+            return "no commands"
+        return "{0} commands, last {1:.3f}ms, mean {2:.3f}ms, max {3:.3f}ms".format(
+            self.n_commands, self.last_latency * 1000,
+            self.total_latency / self.n_commands * 1000, self.max_latency * 1000)
+
+    @staticmethod
+    def parse(data):
+        """Datagram -> (address, [arguments])"""
+        if data.startswith(b'/') and b'\0' in data:
+            return parse_osc(data)
+
+        try:
+            words = data.decode('utf-8').split()
+        except UnicodeDecodeError:
+            raise ValueError("not a command")
+        if not words or not words[0].startswith('/'):
+            raise ValueError("not a command")
+        return words[0], words[1:]
+
+
+def _parse_loop(args, n_loops):
+    if len(args) != 1:
+        return None
+    try:
+        n = int(args[0])
+    except ValueError:
+        return None
+    if not 0 <= n < n_loops:
+        return None
+    return n
+
+
+def _read_osc_string(data, position):
+    end = data.index(b'\0', position)
+    value = data[position:end].decode('utf-8')
+    return value, (end + 4) & ~3  # strings are padded to 4 bytes
+
+
+def parse_osc(data):
+    """OSC message -> (address, [arguments]); int, float and string
+    arguments only."""
+    try:
+        address, position = _read_osc_string(data, 0)
+        if position >= len(data):
+            return address, []  # no type tags
+
+        type_tags, position = _read_osc_string(data, position)
+        if not type_tags.startswith(','):
+            raise ValueError("bad OSC type tags")
+
+        args = []
+        for tag in type_tags[1:]:
+            if tag == 'i':
+                args.append(struct.unpack_from('>i', data, position)[0])
+                position += 4
+            elif tag == 'f':
+                args.append(struct.unpack_from('>f', data, position)[0])
+                position += 4
+            elif tag == 's':
+                value, position = _read_osc_string(data, position)
+                args.append(value)
+            else:
+                raise ValueError("unsupported OSC type {0}".format(tag))
+    except (struct.error, UnicodeDecodeError):
+        raise ValueError("bad OSC message")
+
+    return address, args
+
+
+def send_command(port, command, args=(), timeout=1.0):
+    """Send a text command to a local ControlServer.
+
+    Returns (reply, round trip seconds).
+    """
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(timeout)
+    try:
+        start = time.perf_counter()
+        client.sendto(' '.join([command] + [str(a) for a in args]).encode('utf-8'),
+                      (ControlServer.HOST, port))
+        reply = client.recv(4096).decode('utf-8')
+        return reply, time.perf_counter() - start
+    finally:
+        client.close()
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: python -m midi_notebook.midi_notebook_control PORT COMMAND [LOOP]")
+        print("Commands: {0} /latency".format(
+            ' '.join(sorted(ControlServer.COMMANDS))))
+        sys.exit(1)
+
+    try:
+        reply, round_trip = send_command(
+            int(sys.argv[1]), sys.argv[2], sys.argv[3:])
+    except socket.timeout:
+        print("No reply.")
+        sys.exit(1)
+
+    print("{0} (round trip {1:.3f}ms)".format(reply, round_trip * 1000))
+    if reply.startswith('error'):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""MIDI file export and session archives.
+
+Shared by MidiNotebookContext.save_midi_file and the batch exporter, so that
+a re-rendered session is byte-identical to the live save.
+"""
+
+import json
+
+from midi_notebook.midi_notebook_context import MidiEventTypes, MidiMessage
+
+SESSION_FORMAT_VERSION = 1
+
+
+def build_midi_file(messages, bpm, split_loops=False, write_message=None):
+    """Convert captured messages (time_stamp = seconds since the previous
+    message) to a MIDIFile.
+
+    With split_loops, the loop playback goes to one track per loop instead of
+    the song track.
+    """
+    from midiutil.MidiFile3 import MIDIFile
+
+    if write_message is None:
+        def write_message(message):
+            pass
+
+    song_track = 1
+    tracks = {song_track: "Song track"}
+    if split_loops:
+        for message in messages:
+            if message.loop_index is not None:
+                tracks[song_track + 1 + message.loop_index] = "Loop {0} track".format(
+                    message.loop_index)
+
+    my_midi = MIDIFile(max(tracks) + 1)
+    track = 0
+
+    my_midi.addTrackName(track, 0, "Tempo track")
+    my_midi.addTempo(track, 0, bpm)
+
+    for track, track_name in sorted(tracks.items()):
+        my_midi.addTrackName(track, 0, track_name)
+
+    total_time = 0
+    midi_messages_on = {track: [] for track in tracks}
+    midi_messages_off = {track: [] for track in tracks}
+    midi_messages_controller = {track: [] for track in tracks}
+
+    for message in messages:
+        if len(message) != 3:
+            write_message("wrong length: skipping " + str(message))
+            continue
+
+        track = song_track
+        if split_loops and message.loop_index is not None:
+            track = song_track + 1 + message.loop_index
+
+        total_time += message.time_stamp
+        # seconds -> beat conversion
+        total_time_adjusted = total_time * float(bpm) / float(60)
+
+        if message.type == MidiEventTypes.NOTE_ON:
+            midi_messages_on[track].append(
+                {'note': message[1], 'velocity': message[2], 'time': total_time_adjusted, 'channel': message.channel})
+        elif message.type == MidiEventTypes.NOTE_OFF:
+            midi_messages_off[track].append(
+                {'note': message[1], 'velocity': message[2], 'time': total_time_adjusted, 'channel': message.channel})
+        elif message.type == MidiEventTypes.CONTROL_CHANGE:
+            midi_messages_controller[track].append(
+                {'type': message[1], 'value': message[2], 'time': total_time_adjusted, 'channel': message.channel})
+        else:
+            write_message("unknown message: skipping " + str(message))
+            continue
+
+    for track in sorted(tracks):
+        # each note on ends at the first unused note off of the same note
+        # after it: per note, note offs already passed can never be used by
+        # a later note on, so one pointer per note is enough
+        off_times = {}
+        for m_off in midi_messages_off[track]:
+            off_times.setdefault(m_off['note'], []).append(m_off['time'])
+        next_off = {note: 0 for note in off_times}
+
+        for m_on in midi_messages_on[track]:
+            note = m_on['note']
+            times = off_times.get(note, ())
+            n = next_off.get(note, 0)
+            while n < len(times) and times[n] <= m_on['time']:
+                n += 1
+            if n < len(times):
+                m_on['duration'] = times[n] - m_on['time']
+                next_off[note] = n + 1
+            else:
+                next_off[note] = n
+                m_on['duration'] = float(
+                    15) * float(bpm) / float(60)  # suspended
+
+        for m in midi_messages_on[track]:
+            my_midi.addNote(
+                track, m['channel'], m['note'], m['time'], m['duration'], m['velocity'])
+
+        for m in midi_messages_controller[track]:
+            my_midi.addControllerEvent(
+                track, m['channel'], m['time'], m['type'], m['value'])
+
+    return my_midi
+
+
+def write_midi_file(my_midi, file_path):
+    with open(file_path, 'wb') as binfile:
+        my_midi.writeFile(binfile)
+
+
+def write_session(file_path, messages, bpm, quantize=None):
+    """Archive the raw captured messages, for later re-export.
+
+    quantize: (grid in beats, strength, swing) applied to the saved MIDI
+    file, None if not quantized.
+    """
+    session = {
+        'version': SESSION_FORMAT_VERSION,
+        'bpm': bpm,
+        'quantize': None if quantize is None else list(quantize),
+        'messages': [[m[:], m.time_stamp, m.loop_index] for m in messages],
+    }
+    with open(file_path, 'w') as session_file:
+        json.dump(session, session_file, separators=(',', ':'))
+
+
+def read_session(file_path):
+    """Session archive -> (messages, bpm, quantize)."""
+    with open(file_path) as session_file:
+        session = json.load(session_file)
+
+    if session.get('version') != SESSION_FORMAT_VERSION:
+        raise ValueError("{0}: unsupported session format {1}".format(
+            file_path, session.get('version')))
+
+    messages = [MidiMessage(data, time_stamp, loop_index)
+                for data, time_stamp, loop_index in session['messages']]
+    quantize = session.get('quantize')  # missing in older archives
+    return messages, session['bpm'], None if quantize is None else tuple(quantize)
@@ -0,0 +1,403 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Searchable index of a directory of MIDI files.
+
+The features of each file (pitch class histogram, key, melodic interval
+n-grams, duration, tempo, CC usage) are kept in one JSON file in the
+directory, so that queries never reopen the MIDI files. Files are parsed
+again only when their size or modification time changes. Files added one at
+a time (live saves) are appended to a journal next to it, merged into the
+index at the next full save.
+"""
+
+import os
+import glob
+import json
+import struct
+import multiprocessing
+
+INDEX_FILE_NAME = "midi_notebook.index"
+JOURNAL_FILE_NAME = "midi_notebook.index.journal"  # one JSON line per file
+INDEX_FORMAT_VERSION = 1
+MIDI_FILE_PATTERN = '*.mid'
+
+NGRAM = 3  # melodic intervals per n-gram (NGRAM + 1 notes)
+
+# Krumhansl-Kessler key profiles, from the tonic
+MAJOR_PROFILE = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
+MINOR_PROFILE = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+PITCH_CLASS_NAMES = ['C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B']
+
+
+def _read_variable_length(data, position):
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, position
+
+
+def parse_midi_file(file_path):
+    """Standard MIDI file -> (ticks per beat, channel events as (tick,
+    status, data1, data2) in time order, tempo changes as (tick,
+    microseconds per beat), last tick)."""
+    with open(file_path, 'rb') as midi_file:
+        data = midi_file.read()
+
+    if data[:4] != b'MThd':
+        raise ValueError("{0}: not a MIDI file".format(file_path))
+    header_length, file_format, n_tracks, division = struct.unpack_from(
+        '>IHHH', data, 4)
+    if division & 0x8000:
+        raise ValueError("{0}: SMPTE time is not supported".format(file_path))
+
+    events = []
+    tempos = []
+    end_tick = 0
+    position = 8 + header_length
+
+    while position + 8 <= len(data):
+        chunk_type = data[position:position + 4]
+        chunk_length = struct.unpack_from('>I', data, position + 4)[0]
+        position += 8
+        chunk_end = min(position + chunk_length, len(data))
+        if chunk_type != b'MTrk':
+            position = chunk_end
+            continue
+
+        tick = 0
+        status = None
+        while position < chunk_end:
+            delta, position = _read_variable_length(data, position)
+            tick += delta
+
+            if data[position] >= 0x80:
+                status = data[position]
+                position += 1
+            elif status is None or status >= 0xF0:
+                raise ValueError("{0}: bad running status".format(file_path))
+
+            if status == 0xFF:  # meta
+                meta_type = data[position]
+                length, position = _read_variable_length(data, position + 1)
+                if meta_type == 0x51 and length == 3:
+                    tempos.append((tick, int.from_bytes(
+                        data[position:position + 3], 'big')))
+                position += length
+                status = None
+            elif status in (0xF0, 0xF7):  # sysex
+                length, position = _read_variable_length(data, position)
+                position += length
+                status = None
+            elif status & 0xF0 in (0xC0, 0xD0):
+                events.append((tick, status, data[position], 0))
+                position += 1
+            else:
+                events.append(
+                    (tick, status, data[position], data[position + 1]))
+                position += 2
+
+        end_tick = max(end_tick, tick)
+        position = chunk_end
+
+    events.sort(key=lambda event: event[0])  # stable: tracks keep their order
+    tempos.sort()
+    return division, events, tempos, end_tick
+
+
+def _tick_to_seconds(tick, ticks_per_beat, tempos):
+    seconds = 0.0
+    last_tick = 0
+    tempo = 500000  # 120 bpm, the MIDI default
+    for change_tick, change_tempo in tempos:
+        if change_tick >= tick:
+            break
+        seconds += (change_tick - last_tick) * tempo / 1e6 / ticks_per_beat
+        last_tick, tempo = change_tick, change_tempo
+    return seconds + (tick - last_tick) * tempo / 1e6 / ticks_per_beat
+
+
+def estimate_key(pitch_classes):
+    """Pitch class histogram -> "D minor" (Krumhansl-Kessler), None without
+    notes."""
+    if not any(pitch_classes):
+        return None
+
+    def correlation(x, y):
+        mean_x = sum(x) / 12.0
+        mean_y = sum(y) / 12.0
+        covariance = sum((a - mean_x) * (b - mean_y) for a, b in zip(x, y))
+        variance_x = sum((a - mean_x) ** 2 for a in x)
+        variance_y = sum((b - mean_y) ** 2 for b in y)
+        if variance_x == 0 or variance_y == 0:
+            return 0.0
+        return covariance / (variance_x * variance_y) ** 0.5
+
+    best = None
+    for tonic in range(12):
+        rotated = pitch_classes[tonic:] + pitch_classes[:tonic]
+        for mode, profile in (('major', MAJOR_PROFILE), ('minor', MINOR_PROFILE)):
+            score = correlation(rotated, profile)
+            if best is None or score > best[0]:
+                best = (score, "{0} {1}".format(PITCH_CLASS_NAMES[tonic], mode))
+    return best[1]
+
+
+def melody_ngrams(pitches):
+    """Hashes of the NGRAM intervals runs of a pitch sequence: transposed
+    melodies share them. Intervals are clipped to +/- 63 semitones and packed
+    in 7 bits each, so equal hashes are equal runs."""
+    intervals = [max(-63, min(63, b - a)) + 64 for a, b in zip(pitches, pitches[1:])]
+    ngrams = set()
+    for n in range(len(intervals) - NGRAM + 1):
+        value = 0
+        for interval in intervals[n:n + NGRAM]:
+            value = (value << 7) | interval
+        ngrams.add(value)
+    return ngrams
+
+
+def extract_features(file_path):
+    ticks_per_beat, events, tempos, end_tick = parse_midi_file(file_path)
+
+    pitch_classes = [0 for n in range(12)]
+    controllers = {}
+    melody = []  # top note of each onset
+    melody_tick = None
+    n_notes = 0
+
+    for tick, status, data1, data2 in events:
+        kind = status & 0xF0
+        if kind == 0x90 and data2 > 0:
+            n_notes += 1
+            pitch_classes[data1 % 12] += 1
+            if tick == melody_tick:
+                melody[-1] = max(melody[-1], data1)
+            else:
+                melody.append(data1)
+                melody_tick = tick
+        elif kind == 0xB0:
+            controllers[str(data1)] = controllers.get(str(data1), 0) + 1
+
+    stat = os.stat(file_path)
+    return {
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'duration': round(_tick_to_seconds(end_tick, ticks_per_beat, tempos), 3),
+        'bpm': round(60e6 / tempos[0][1], 2) if tempos else 120.0,
+        'notes': n_notes,
+        'pitch_classes': pitch_classes,
+        'key': estimate_key(pitch_classes),
+        'cc': controllers,
+        'ngrams': sorted(melody_ngrams(melody)),
+    }
+
+
+def _index_file(file_path):
+    try:
+        return os.path.basename(file_path), extract_features(file_path), None
+    except (IOError, ValueError, IndexError, struct.error) as e:
+        return os.path.basename(file_path), None, str(e)
+
+
+def add_to_journal(file_path):
+    """Index one new file into the journal of its directory, without
+    loading the index (live saves). Returns (file name, features)."""
+    name, features, error = _index_file(file_path)
+    if features is None:
+        raise ValueError(error)
+    journal_path = os.path.join(os.path.dirname(file_path), JOURNAL_FILE_NAME)
+    with open(journal_path, 'a') as journal_file:
+        journal_file.write(json.dumps(
+            [INDEX_FORMAT_VERSION, name, features], separators=(',', ':')) + '\n')
+    return name, features
+
+
+class MidiIndex():
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, INDEX_FILE_NAME)
+        self.journal_path = os.path.join(directory, JOURNAL_FILE_NAME)
+        self.files = {}  # file name -> features
+        self.postings = {}  # n-gram -> set of file names
+
+    def load(self):
+        self.files = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+            if index.get('version') == INDEX_FORMAT_VERSION:
+                self.files = index['files']
+
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path) as journal_file:
+                for line in journal_file:
+                    try:
+                        version, name, features = json.loads(line)
+                    except ValueError:
+                        continue  # e.g. interrupted while writing
+                    if version == INDEX_FORMAT_VERSION:
+                        self.files[name] = features
+
+        self.postings = {}
+        for name, features in self.files.items():
+            self._add_postings(name, features)
+        return self
+
+    def save(self):
+        index = {'version': INDEX_FORMAT_VERSION, 'files': self.files}
+        temporary_path = self.index_path + '.tmp'
+        with open(temporary_path, 'w') as index_file:
+            json.dump(index, index_file, separators=(',', ':'))
+        os.replace(temporary_path, self.index_path)
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)  # merged
+
+    def _add_postings(self, name, features):
+        for ngram in features['ngrams']:
+            self.postings.setdefault(ngram, set()).add(name)
+
+    def _remove(self, name):
+        features = self.files.pop(name)
+        for ngram in features['ngrams']:
+            names = self.postings.get(ngram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.postings[ngram]
+
+    def _store(self, name, features):
+        if name in self.files:
+            self._remove(name)
+        self.files[name] = features
+        self._add_postings(name, features)
+
+    def update(self, jobs=None, write_message=print):
+        """Index new and changed files of the directory, in parallel, and
+        forget the deleted ones. Returns the number of files parsed."""
+        on_disk = {}
+        for file_path in glob.glob(os.path.join(self.directory, MIDI_FILE_PATTERN)):
+            stat = os.stat(file_path)
+            on_disk[os.path.basename(file_path)] = (stat.st_mtime, stat.st_size)
+
+        removed = [name for name in self.files if name not in on_disk]
+        for name in removed:
+            self._remove(name)
+
+        changed = [os.path.join(self.directory, name)
+                   for name, (mtime, size) in sorted(on_disk.items())
+                   if name not in self.files or
+                   (self.files[name]['mtime'], self.files[name]['size']) != (mtime, size)]
+
+        if len(changed) > 1 and jobs != 1:
+            with multiprocessing.Pool(jobs) as pool:
+                results = list(pool.imap_unordered(_index_file, changed, chunksize=16))
+        else:
+            results = [_index_file(file_path) for file_path in changed]
+
+        for name, features, error in results:
+            if features is None:
+                write_message("{0}: skipped ({1})".format(name, error))
+                continue
+            self._store(name, features)
+
+        if removed or changed or os.path.isfile(self.journal_path):
+            self.save()
+        return len(changed)
+
+    def add_file(self, file_path):
+        """Index one new file, e.g. just saved: appended to the journal."""
+        name, features = add_to_journal(file_path)
+        self._store(name, features)
+
+    def search(self, melody=None, key=None, cc=None, min_cc_count=1,
+               min_bpm=None, max_bpm=None, min_duration=None, max_duration=None):
+        """-> [(score, file name)], best and then newest first.
+
+        melody: pitches (any transposition); score = fraction of its n-grams
+                found in the file
+        key: "D" (major or minor) or "D minor", sharps or flats
+        cc: controller number used at least min_cc_count times
+        """
+        if melody is not None:
+            scores = {}
+            query = melody_ngrams(melody)
+            if not query:
+                raise ValueError(
+                    "a melody needs at least {0} notes".format(NGRAM + 1))
+            for ngram in query:
+                for name in self.postings.get(ngram, ()):
+                    scores[name] = scores.get(name, 0) + 1
+            candidates = [(count / float(len(query)), name)
+                          for name, count in scores.items()]
+        else:
+            candidates = [(1.0, name) for name in self.files]
+
+        results = []
+        for score, name in candidates:
+            features = self.files[name]
+            if key is not None and not _key_matches(features['key'], key):
+                continue
+            if cc is not None and features['cc'].get(str(cc), 0) < min_cc_count:
+                continue
+            if min_bpm is not None and features['bpm'] < min_bpm:
+                continue
+            if max_bpm is not None and features['bpm'] > max_bpm:
+                continue
+            if min_duration is not None and features['duration'] < min_duration:
+                continue
+            if max_duration is not None and features['duration'] > max_duration:
+                continue
+            if cc is not None and melody is None:
+                score = features['cc'][str(cc)]  # the most used first
+            results.append((score, name))
+
+        results.sort(key=lambda result: (
+            -result[0], -self.files[result[1]]['mtime'], result[1]))
+        return results
+
+
+def parse_note(name):
+    """"D", "Eb3", "F#4" -> (pitch class, MIDI note or None without the
+    octave); C4 = 60."""
+    letters = {'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7, 'a': 9, 'b': 11}
+    name = name.strip()
+    if not name or name[0].lower() not in letters:
+        raise ValueError("bad note name {0}".format(name))
+
+    pitch = letters[name[0].lower()]
+    n = 1
+    while n < len(name) and name[n] in '#b':
+        pitch += 1 if name[n] == '#' else -1
+        n += 1
+
+    if n == len(name):
+        return pitch % 12, None
+    return pitch % 12, pitch + 12 * (int(name[n:]) + 1)
+
+
+def _key_matches(file_key, query):
+    if file_key is None:
+        return False
+    tonic, mode = file_key.split()
+    words = query.split()
+    if parse_note(words[0])[0] != PITCH_CLASS_NAMES.index(tonic):
+        return False
+    return len(words) == 1 or words[1].lower() == mode
@@ -0,0 +1,78 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import collections
+
+
+class OutputPool():
+
+    """MIDI output ports opened on first use and shared by all loops.
+
+    Batches sent to the same port at the same time by several loop players
+    are combined: whoever holds the port sends the queued batches of the
+    others too, so the other players never block on the port.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.lock = threading.Lock()  # opening and closing ports
+        # port -> (MidiOut, Lock held while sending, deque of batches to
+        # send): replaced as a whole, so a sender never sees half of it
+        self.outputs = {}
+
+    def get(self, port):
+        entry = self.outputs.get(port)
+        if entry is not None:
+            return entry
+
+        with self.lock:
+            if port not in self.outputs:
+                output = self.context.midi_backend.MidiOut()
+                output.open_port(port)
+                self.outputs[port] = (output, threading.Lock(), collections.deque())
+            return self.outputs[port]
+
+    def send_batch(self, port, messages, start=0, end=None):
+        """Send messages[start:end] to the port, in order, skipping None."""
+        entry = self.get(port)
+        output, port_lock, pending = entry
+
+        pending.append((messages, start, len(messages) if end is None else end))
+
+        # anything queued is sent by whoever holds the port
+        while pending:
+            if not port_lock.acquire(False):
+                return
+            try:
+                if self.outputs.get(port) is not entry:
+                    pending.clear()  # closed meanwhile
+                    return
+                while pending:
+                    batch, batch_start, batch_end = pending.popleft()
+                    for n in range(batch_start, batch_end):
+                        if batch[n] is not None:
+                            output.send_message(batch[n])
+            finally:
+                port_lock.release()
+
+    def close_all(self):
+        with self.lock:
+            outputs = self.outputs
+            self.outputs = {}
+            for output, port_lock, pending in outputs.values():
+                with port_lock:
+                    output.close_port()
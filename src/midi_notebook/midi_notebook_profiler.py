@@ -0,0 +1,189 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Opt-in profiling of the capture and playback hot paths.
+
+Both modes write "folded" stacks (one "frame;frame;frame weight" line per
+stack), the input format of flamegraph.pl, inferno and speedscope.
+Nothing is patched or started until Profiler.start() is called.
+"""
+
+import os
+import sys
+import time
+import datetime
+import threading
+import functools
+import collections
+
+from midi_notebook.midi_notebook_context import MidiNotebookContext, LoopPlayer
+
+
+class Profiler():
+
+    MODES = ('sampling', 'timers')
+
+    # (class, method name) wrapped in 'timers' mode
+    HOT_PATHS = [
+        (MidiNotebookContext, 'capture_message'),
+        (MidiNotebookContext, 'handle_message_loop'),
+        (MidiNotebookContext, 'write_midi_message'),
+        (MidiNotebookContext, 'save_midi_file'),
+        (LoopPlayer, 'play_batch'),  # not run_unsafe: it sleeps, never returns
+    ]
+
+    PROFILE_FILE_NAME = 'midi_notebook_profile_{0}_{1}.folded'  # mode, datetime
+
+    def __init__(self, mode='sampling', interval=0.001, output_dir=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown profile mode: {0}".format(mode))
+
+        self.mode = mode
+        self.interval = interval
+        self.output_dir = output_dir
+        if self.output_dir is None:
+            self.output_dir = os.path.dirname(sys.argv[0])
+
+        self.stacks = collections.Counter()
+        self.stacks_lock = threading.Lock()
+        self.originals = []
+        self.sampler = None
+        self.is_running = False
+        self.thread_stacks = threading.local()
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+
+        if self.mode == 'timers':
+            self._patch()
+        else:
+            self.sampler = threading.Thread(target=self._sample_loop)
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    def stop(self):
+        if not self.is_running:
+            return
+        self.is_running = False
+
+        if self.mode == 'timers':
+            self._unpatch()
+        else:
+            self.sampler.join()
+            self.sampler = None
+
+    def write(self):
+        file_name = self.PROFILE_FILE_NAME.format(
+            self.mode, datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+        file_path = os.path.join(self.output_dir, file_name)
+
+        with self.stacks_lock:
+            lines = ["{0} {1}".format(stack, weight)
+                     for stack, weight in sorted(self.stacks.items())]
+
+        with open(file_path, 'w') as profile_file:
+            profile_file.write('\n'.join(lines) + '\n')
+
+        return file_path
+
+    # timers: weight = self time in microseconds
+
+    def _patch(self):
+        for cls, name in self.HOT_PATHS:
+            original = cls.__dict__[name]
+            self.originals.append((cls, name, original))
+            setattr(cls, name, self._timed(original, cls.__name__ + '.' + name))
+
+    def _unpatch(self):
+        for cls, name, original in self.originals:
+            setattr(cls, name, original)
+        self.originals = []
+
+    def _timed(self, function, label):
+        profiler = self
+
+        @functools.wraps(function)
+        def wrapper(*args, **kw):
+            stack = profiler._current_stack()
+            stack.append([label, 0.0])  # name, time spent in children
+            start = time.perf_counter()
+            try:
+                return function(*args, **kw)
+            finally:
+                elapsed = time.perf_counter() - start
+                path = ';'.join(frame[0] for frame in stack)
+                children_time = stack.pop()[1]
+                if stack:
+                    stack[-1][1] += elapsed
+                profiler._add(path, int((elapsed - children_time) * 1e6))
+
+        return wrapper
+
+    def _current_stack(self):
+        if not hasattr(self.thread_stacks, 'stack'):
+            self.thread_stacks.stack = [
+                [threading.current_thread().name, 0.0]]
+        return self.thread_stacks.stack
+
+    # sampling: weight = number of samples
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        names = {}
+
+        while self.is_running:
+            time.sleep(self.interval)
+
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append("{0} ({1}:{2})".format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                self._add(';'.join(frames[::-1]), 1)
+
+    def _add(self, path, weight):
+        with self.stacks_lock:
+            self.stacks[path] += weight
+
+
+def parse_profile_argument(arg):
+    """'--profile' or '--profile=MODE' -> mode, None if malformed; the
+    mode is to be checked against Profiler.MODES."""
+    if arg == '--profile':
+        return 'sampling'
+    if not arg.startswith('--profile='):
+        return None
+    return arg[len('--profile='):]
+
+
+def stop_profiler(context):
+    """Stop the context profiler, if any, and write its output."""
+    if context.profiler is None:
+        return
+    context.profiler.stop()
+    context.write_message(
+        "Profile written to {0}.".format(context.profiler.write()))
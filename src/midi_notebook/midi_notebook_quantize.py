@@ -0,0 +1,148 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Quantization of loop takes and exported sessions (requires numpy).
+
+Note ons are moved towards the nearest grid point; each note off moves with
+its note on, so durations are kept. Other messages are left in place.
+"""
+
+# numpy is an optional dependency: imported when quantization is enabled
+
+
+def preload():
+    """Import numpy now rather than at the first use, which may be on the
+    MIDI input thread."""
+    import numpy
+
+
+def quantize_times(times, status, data1, data2, grid, strength=1.0, swing=0.0, end=None):
+    """New event times (numpy arrays in, numpy array out).
+
+    times: seconds from the grid origin, in increasing order
+    grid: seconds between grid points
+    strength: 0 (no change) to 1 (on the grid)
+    swing: fraction of the grid by which odd grid points are delayed
+           (0 = straight, 1/3 = triplets); less than 1
+    end: new times are clipped to [0, end]
+    """
+    import numpy as np
+
+    kind = status & 0xF0
+    is_on = (kind == 0x90) & (data2 > 0)
+    is_off = (kind == 0x80) | ((kind == 0x90) & (data2 == 0))
+
+    # nearest (swung) grid point, from the two around each note on
+    t = times[is_on]
+    k = np.floor(t / grid)
+    lower = (k + (k % 2) * swing) * grid
+    upper = (k + 1 + ((k + 1) % 2) * swing) * grid
+    target = np.where(np.abs(t - lower) <= np.abs(upper - t), lower, upper)
+
+    shift = np.zeros(len(times))
+    shift[is_on] = strength * (target - t)
+
+    pair = pair_note_offs(status, data1, is_on, is_off)
+    paired = pair >= 0
+    shift[paired] = shift[pair[paired]]
+
+    result = times + shift
+    np.clip(result, 0, end, out=result)
+    return result
+
+
+def pair_note_offs(status, data1, is_on, is_off):
+    """For each event, the index of the note on a note off ends (first in
+    first out per channel and note), -1 for other events and for note offs
+    without a note on."""
+    import numpy as np
+
+    pair = np.full(len(status), -1, dtype=np.int64)
+    events = np.flatnonzero(is_on | is_off)
+    if len(events) == 0:
+        return pair
+
+    # group by channel and note, in time order within each group
+    keys = (status[events] & 0x0F).astype(np.int64) * 128 + data1[events]
+    order = np.argsort(keys, kind='stable')
+    events = events[order]
+    keys = keys[order]
+    on = is_on[events]
+
+    group_start = np.ones(len(events), dtype=bool)
+    group_start[1:] = keys[1:] != keys[:-1]
+    group = np.cumsum(group_start) - 1
+    first = np.flatnonzero(group_start)
+
+    # counts so far within the group, this event included
+    ons_total = np.cumsum(on)
+    offs_total = np.cumsum(~on)
+    ons_before_group = (ons_total - on)[first][group]
+    ons = ons_total - ons_before_group
+    offs = offs_total - (offs_total - ~on)[first][group]
+
+    # note offs with no pending note on: the running maximum of offs - ons,
+    # restarted in each group by offsetting the groups apart
+    span = 2 * len(events) + 2
+    deficit = offs - ons
+    orphans = np.maximum.accumulate(deficit + group * span) - group * span
+    np.maximum(orphans, 0, out=orphans)
+    orphans_before = np.zeros(len(events), dtype=orphans.dtype)
+    orphans_before[1:] = orphans[:-1]
+    orphans_before[group_start] = 0
+
+    matched = ~on & (orphans == orphans_before)
+    # the n-th matched note off of a group ends its n-th note on
+    rank = offs[matched] - 1 - orphans[matched]
+    on_positions = np.flatnonzero(on)
+    pair[events[matched]] = events[on_positions[ons_before_group[matched] + rank]]
+    return pair
+
+
+def quantize_messages(messages, grid, strength=1.0, swing=0.0, first_time=0.0, end=None):
+    """Quantize messages with time_stamp = seconds since the previous
+    message; the first one is at first_time from the grid origin.
+
+    Returns new messages, in time order; the time_stamp of the first one is
+    its time from the grid origin.
+    """
+    import numpy as np
+
+    if not messages:
+        return []
+
+    n = len(messages)
+    times = np.fromiter((float(m.time_stamp) for m in messages), float, n)
+    times[0] = first_time
+    np.cumsum(times, out=times)
+
+    # messages shorter than 3 bytes are never notes
+    status = np.fromiter((m[0] for m in messages), np.int64, n)
+    data1 = np.fromiter((m[1] if len(m) > 1 else 0 for m in messages), np.int64, n)
+    data2 = np.fromiter((m[2] if len(m) > 2 else 0 for m in messages), np.int64, n)
+
+    times = quantize_times(times, status, data1, data2, grid, strength, swing, end)
+
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    deltas = np.diff(times, prepend=0.0)
+
+    result = []
+    for index, delta in zip(order.tolist(), deltas.tolist()):
+        message = messages[index].clone()
+        message.time_stamp = delta
+        result.append(message)
+    return result
@@ -0,0 +1,308 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""MIDI Notebook soak test.
+
+Plays random phrases into a virtual input port for a long time, toggling
+loops at random, and samples memory, threads and the size of every growing
+structure. Fails if RSS or the live thread count are not bounded, or if the
+capture throughput drops: events handled per second of wall time spent in
+the input callbacks (capture, loop recording and toggles), late in the run
+against early.
+
+Usage (from the src directory):
+python -m midi_notebook.midi_notebook_soak [-durationSECONDS] [-rateEVENTS] [-seedN] [-simulated]
+
+With -simulated, the session runs on a SimulatedClock: hours of input take
+minutes; the capture throughput is still measured in wall time.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+
+from midi_notebook.midi_notebook_context import MidiNotebookContext, LoopPlayer
+from midi_notebook.midi_notebook_virtual import VirtualMidiBackend
+from midi_notebook.midi_notebook_clock import RealClock, SimulatedClock
+
+
+def get_rss():
+    """Resident set size in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource  # peak value only, but better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SoakTest():
+
+    # sampled metrics: name -> function(soak test)
+    METRICS = [
+        ('rss_mb', lambda t: get_rss() / 1024.0 / 1024.0),
+        ('threads', lambda t: threading.active_count()),
+        ('loop_players', lambda t: len(
+            [th for th in threading.enumerate() if isinstance(th, LoopPlayer)])),
+        ('session_messages', lambda t: len(t.context.messages_captured)),
+        ('loopback_references', lambda t: len(t.context.loopback_captured)),
+        ('loop_messages', lambda t: sum(
+            len(l.messages_captured) for l in t.context.loops)),
+        ('monitor_lines', lambda t: t.monitor_lines),
+        ('capture_events_per_sec', lambda t: t.capture_throughput()),
+    ]
+
+    # metrics which must stay bounded
+    BOUNDED_METRICS = ['rss_mb', 'threads', 'loop_players']
+
+    def __init__(self, duration=60, rate=20, seed=0, sample_interval=1.0,
+                 phrase_length=20, long_pause=2, toggles_per_minute=6,
+                 max_rss_growth_mb=20, max_threads=16, min_throughput_ratio=0.8,
+                 simulated=False):
+        self.clock = SimulatedClock() if simulated else RealClock()
+        self.duration = duration
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.sample_interval = sample_interval
+        self.phrase_length = phrase_length
+        self.toggles_per_minute = toggles_per_minute
+        self.max_rss_growth_mb = max_rss_growth_mb
+        self.max_threads = max_threads
+        self.min_throughput_ratio = min_throughput_ratio
+
+        self.monitor_lines = 0
+        self.events_sent = 0
+        self.capture_time = 0.0  # wall time spent in send_input()
+        self.last_sample = (0, 0.0)  # (events_sent, capture_time)
+        self.capture_samples = []  # (events, capture time) per sample
+        self.samples = []
+
+        self.output_dir = tempfile.mkdtemp(prefix='midi_notebook_soak_')
+        self.backend = VirtualMidiBackend(clock=self.clock)
+        self.context = MidiNotebookContext({
+            'long_pause': long_pause,
+            'midi_file_name': 'soak_{0}.mid',
+            'session_file_name': None,
+            'output_dir': self.output_dir,
+            'bpm': 120,
+            'monitor': True,
+            'write_message_function': self.write_message,
+            'loop_toggle_message_signature':
+            [[21, 127], [22, 127], [23, 127], [24, 127], ],
+            'midi_backend': self.backend,
+            'clock': self.clock,
+        })
+        self.context.output_port = 0
+
+    def write_message(self, message):
+        # stands for the GUI scrollback / console
+        self.monitor_lines += 1
+
+    def send(self, data):
+        """One input event, timed: the callbacks run in send_input()."""
+        start = time.perf_counter()
+        self.backend.send_input(0, data)
+        self.capture_time += time.perf_counter() - start
+        self.events_sent += 1
+
+    def capture_throughput(self):
+        """Events per second of capture wall time, since the last sample
+        (None if no events)."""
+        last_events, last_time = self.last_sample
+        self.last_sample = (self.events_sent, self.capture_time)
+        events = self.events_sent - last_events
+        busy = self.capture_time - last_time
+        self.capture_samples.append((events, busy))
+        if events == 0:
+            return None
+        return events / max(busy, 1e-9)
+
+    def run(self):
+        self.context.start_recording()
+
+        main_loop = threading.Thread(target=self.run_main_loop)
+        main_loop.daemon = True
+        self.clock.add_thread()
+        main_loop.start()
+
+        try:
+            self.play()
+        finally:
+            shutil.rmtree(self.output_dir, ignore_errors=True)
+
+        return self.report()
+
+    def run_main_loop(self):
+        try:
+            self.context.start_main_loop()
+        finally:
+            self.clock.remove_thread()
+
+    def play(self):
+        start = self.clock.time()
+        next_sample = start
+        next_event = start
+        phrase_end = start + self.phrase_length
+        notes_on = []
+
+        while self.clock.time() - start < self.duration:
+            now = self.clock.time()
+
+            if now >= next_sample:
+                self.sample(now - start)
+                next_sample += self.sample_interval
+
+            if now >= phrase_end:
+                # a pause, long enough for the autosave
+                for note in notes_on:
+                    self.send([128, note, 0])
+                notes_on = []
+                next_sample = self.pause(
+                    self.context.long_pause + 1.5, start, next_sample)
+                next_event = self.clock.time()
+                phrase_end = next_event + self.phrase_length
+                continue
+
+            if self.random.random() < self.toggles_per_minute / 60.0 / self.rate:
+                n = self.random.randrange(self.context.n_loops)
+                self.send([176] + self.context.loop_toggle_message_signature[n])
+            elif notes_on and (len(notes_on) > 4 or self.random.random() < 0.5):
+                self.send([128, notes_on.pop(0), 0])
+            else:
+                note = self.random.randrange(36, 96)
+                notes_on.append(note)
+                self.send([144, note, self.random.randrange(1, 128)])
+
+            next_event += 1.0 / self.rate
+            self.clock.sleep(max(0, next_event - self.clock.time()))
+
+        self.sample(self.clock.time() - start)
+
+    def pause(self, duration, start, next_sample):
+        pause_end = self.clock.time() + duration
+        while self.clock.time() < pause_end:
+            if self.clock.time() >= next_sample:
+                self.sample(self.clock.time() - start)
+                next_sample += self.sample_interval
+            self.clock.sleep(max(0, min(next_sample, pause_end) - self.clock.time()))
+        return next_sample
+
+    def sample(self, elapsed):
+        self.samples.append(
+            [elapsed] + [metric(self) for name, metric in self.METRICS])
+
+    def report(self):
+        names = [name for name, metric in self.METRICS]
+        lines = []
+        failures = []
+
+        lines.append("{0:<24}{1:>12}{2:>12}{3:>12}{4:>14}".format(
+            'metric', 'first', 'max', 'last', 'slope/hour'))
+
+        # skip the warm-up (first quarter) for growth and bounds
+        steady = self.samples[len(self.samples) // 4:]
+
+        for n, name in enumerate(names):
+            values = [s[n + 1] for s in steady if s[n + 1] is not None]
+            if not values:
+                continue
+            slope = self.slope(
+                [s[0] for s in steady if s[n + 1] is not None], values) * 3600
+            growing = self.is_growing(values)
+            lines.append("{0:<24}{1:>12.1f}{2:>12.1f}{3:>12.1f}{4:>14.1f}{5}".format(
+                name, values[0], max(values), values[-1], slope,
+                '  <-- GROWING' if growing else ''))
+            if growing and name in self.BOUNDED_METRICS:
+                failures.append("{0} is growing".format(name))
+
+        rss = [s[names.index('rss_mb') + 1] for s in steady]
+        if max(rss) - rss[0] > self.max_rss_growth_mb:
+            failures.append("RSS grew by {0:.1f}MB".format(max(rss) - rss[0]))
+
+        threads = max(s[names.index('threads') + 1] for s in self.samples)
+        if threads > self.max_threads:
+            failures.append("{0} live threads".format(threads))
+
+        # totals of each half, not a mean of the noisy per sample values
+        capture = [c for c in self.capture_samples[1:-1] if c[0] > 0]
+        if len(capture) >= 2:
+            half = len(capture) // 2
+
+            ratio = self.events_per_second(capture[half:]) / \
+                max(self.events_per_second(capture[:half]), 1e-9)
+            lines.append("capture throughput ratio (second half / first half): {0:.2f}".format(
+                ratio))
+            if ratio < self.min_throughput_ratio:
+                failures.append(
+                    "capture throughput dropped to {0:.0%}".format(ratio))
+
+        for failure in failures:
+            lines.append("FAIL: " + failure)
+        if not failures:
+            lines.append("OK")
+
+        return '\n'.join(lines), failures
+
+    @staticmethod
+    def events_per_second(capture_samples):
+        events = sum(e for e, t in capture_samples)
+        return events / max(sum(t for e, t in capture_samples), 1e-9)
+
+    @staticmethod
+    def slope(xs, ys):
+        """Least squares slope."""
+        n = len(xs)
+        if n < 2:
+            return 0.0
+        mean_x = sum(xs) / n
+        mean_y = sum(ys) / n
+        var_x = sum((x - mean_x) ** 2 for x in xs)
+        if var_x == 0:
+            return 0.0
+        return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+
+    @staticmethod
+    def is_growing(values):
+        """Each quarter of the run reaches a new maximum."""
+        if len(values) < 8:
+            return False
+        quarter = len(values) // 4
+        maxima = [max(values[i * quarter:(i + 1) * quarter]) for i in range(4)]
+        return all(b > a * 1.05 for a, b in zip(maxima, maxima[1:]))
+
+
+def main():
+    options = {}
+    for arg in sys.argv[1:]:
+        if arg.startswith("-duration"):
+            options['duration'] = float(arg[9:])
+        if arg.startswith("-rate"):
+            options['rate'] = float(arg[5:])
+        if arg.startswith("-seed"):
+            options['seed'] = int(arg[5:])
+        if arg == "-simulated":
+            options['simulated'] = True
+
+    report, failures = SoakTest(**options).run()
+    print(report)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import collections
+
+
+class SessionStatistics():
+
+    """Live session statistics, updated in constant time per event: what
+    is heard (live input and loop playback) and what the loops record.
+
+    The capture path only queues its events (add, add_recorded), without
+    locks; they are aggregated by update(), which the main loop calls every
+    second, and by the readers and the loop players, under the lock.
+
+    Rates are over the last WINDOW seconds, in one bucket per second.
+    """
+
+    WINDOW = 10  # seconds
+    VELOCITY_BINS = 8
+
+    def __init__(self, n_loops):
+        self.n_loops = n_loops
+        self.lock = threading.Lock()  # never taken by the capture path
+        self.pending = collections.deque()  # (message, time, loop index)
+        self.version = 0  # bumped on every update, never reset
+        self.summary_version = None  # version of the last summary()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.pending.clear()
+            self.version += 1
+            self.events = 0
+            self.channel_events = [0 for n in range(16)]
+            self.loop_recorded = [0 for n in range(self.n_loops)]
+            self.loop_played = [0 for n in range(self.n_loops)]
+            self.velocities = [0 for n in range(128)]
+            self.sounding = {}  # (channel, note) -> note ons not ended
+            self.voices = 0
+            self.peak_voices = 0
+            self.bucket_seconds = [None for n in range(self.WINDOW)]
+            self.note_buckets = [0 for n in range(self.WINDOW)]
+            self.cc_buckets = [0 for n in range(self.WINDOW)]
+
+    def add(self, message, now, loop_index=None):
+        """A message heard: live input, or played by loop loop_index."""
+        self.pending.append((message, now, loop_index))
+
+    def add_recorded(self, loop_index):
+        self.pending.append((None, None, loop_index))
+
+    def add_batch(self, messages, start, end, now, loop_index):
+        """messages[start:end], played together by loop loop_index."""
+        with self.lock:
+            self._update()  # earlier events first
+            for n in range(start, end):
+                if messages[n] is not None:  # None = filtered out
+                    self._add(messages[n], now)
+                    self.loop_played[loop_index] += 1
+
+    def update(self):
+        """Aggregate the queued events; returns the version."""
+        with self.lock:
+            self._update()
+            return self.version
+
+    def _update(self):
+        # with self.lock held
+        pending = self.pending
+        while pending:
+            message, now, loop_index = pending.popleft()
+            if message is None:
+                self.version += 1
+                self.loop_recorded[loop_index] += 1
+                continue
+            self._add(message, now)
+            if loop_index is not None:
+                self.loop_played[loop_index] += 1
+
+    def _add(self, message, now):
+        # with self.lock held
+        self.version += 1
+        self.events += 1
+
+        status = message[0]
+        if status >= 0xF0 or len(message) < 3:
+            return  # system messages
+        kind = status & 0xF0
+        channel = status & 0x0F
+        self.channel_events[channel] += 1
+
+        if kind == 0x90 and message[2] > 0:
+            bucket = self._bucket(now)
+            if bucket is not None:
+                self.note_buckets[bucket] += 1
+            self.velocities[message[2]] += 1
+            key = (channel, message[1])
+            self.sounding[key] = self.sounding.get(key, 0) + 1
+            self.voices += 1
+            if self.voices > self.peak_voices:
+                self.peak_voices = self.voices
+        elif kind == 0x80 or kind == 0x90:
+            key = (channel, message[1])
+            count = self.sounding.get(key, 0)
+            if count > 1:
+                self.sounding[key] = count - 1
+                self.voices -= 1
+            elif count == 1:
+                del self.sounding[key]
+                self.voices -= 1
+        elif kind == 0xB0:
+            bucket = self._bucket(now)
+            if bucket is not None:
+                self.cc_buckets[bucket] += 1
+
+    def _bucket(self, now):
+        """Bucket of the second now, None if it is out of the window."""
+        second = int(now)
+        n = second % self.WINDOW
+        if self.bucket_seconds[n] is not None and self.bucket_seconds[n] > second:
+            return None  # aggregated late
+        if self.bucket_seconds[n] != second:
+            self.bucket_seconds[n] = second
+            self.note_buckets[n] = 0
+            self.cc_buckets[n] = 0
+        return n
+
+    def _rate(self, buckets, now):
+        first = int(now) - self.WINDOW
+        return sum(count for second, count in zip(self.bucket_seconds, buckets)
+                   if second is not None and second > first) / float(self.WINDOW)
+
+    def notes_per_second(self, now):
+        return self._rate(self.note_buckets, now)
+
+    def cc_per_second(self, now):
+        return self._rate(self.cc_buckets, now)
+
+    def velocity_histogram(self):
+        size = 128 // self.VELOCITY_BINS
+        return [sum(self.velocities[n:n + size]) for n in range(0, 128, size)]
+
+    def velocity_median(self):
+        total = sum(self.velocities)
+        if total == 0:
+            return None
+        count = 0
+        for velocity, n in enumerate(self.velocities):
+            count += n
+            if 2 * count >= total:
+                return velocity
+
+    def summary(self, now):
+        """A consistent snapshot of the statistics, as text."""
+        with self.lock:
+            self._update()
+            self.summary_version = self.version
+            channels = ' '.join("{0}:{1}".format(n + 1, count)
+                                for n, count in enumerate(self.channel_events) if count)
+            return ("{0:.1f} notes/s, {1:.1f} CC/s, {2} voices (peak {3}), "
+                    "velocity median {4} {5}, channels {6}, "
+                    "loops recorded {7} played {8}").format(
+                self.notes_per_second(now), self.cc_per_second(now),
+                self.voices, self.peak_voices, self.velocity_median(),
+                self.velocity_histogram(), channels or '-',
+                '/'.join(str(n) for n in self.loop_recorded),
+                '/'.join(str(n) for n in self.loop_played))
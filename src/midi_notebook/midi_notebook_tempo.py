@@ -0,0 +1,159 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tempo detection from note onsets (requires numpy).
+
+The onsets are binned into an envelope whose autocorrelation, computed with
+an FFT, is the histogram of the intervals between every pair of onsets: the
+beat is its strongest peak in the tempo range, with a mild preference for
+tempos near PREFERRED_BPM against double/half tempo mistakes.
+"""
+
+# numpy is an optional dependency: imported when tempo detection is enabled
+
+
+def preload():
+    """Import numpy now rather than at the first use, which may be on the
+    MIDI input thread."""
+    import numpy
+
+RESOLUTION = 0.005  # seconds per envelope bin
+JITTER = 0.01  # seconds, standard deviation of the human timing tolerated
+MIN_BPM = 50
+MAX_BPM = 220
+PREFERRED_BPM = 120
+PREFERENCE_WIDTH = 1.5  # octaves, standard deviation of the preference
+
+
+def onset_times(messages, first_time=0.0):
+    """(times, velocities) of the note ons of messages with time_stamp =
+    seconds since the previous message, the first one at first_time."""
+    import numpy as np
+
+    n = len(messages)
+    times = np.fromiter((float(m.time_stamp) for m in messages), float, n)
+    if n == 0:
+        return times, times
+    times[0] = first_time
+    np.cumsum(times, out=times)
+
+    is_on = np.fromiter(
+        (len(m) == 3 and m[0] & 0xF0 == 0x90 and m[2] > 0 for m in messages), bool, n)
+    velocities = np.fromiter(
+        (m[2] if len(m) == 3 else 0 for m in messages), float, n)
+    return times[is_on], velocities[is_on]
+
+
+def detect_tempo(onsets, velocities=None, duration=None):
+    """Onset times (seconds) -> (bpm, beats per bar), None if there are too
+    few onsets.
+
+    With velocities, accented onsets count more (this mostly helps to find
+    the bar).
+
+    With duration, the onsets are one cycle of a loop that long: the beat is
+    adjusted so that the loop lasts a whole number of beats.
+    """
+    import numpy as np
+
+    onsets = np.asarray(onsets, dtype=float)
+    if len(onsets) < 4:
+        return None
+
+    if duration is None:
+        bins = np.rint((onsets - onsets.min()) / RESOLUTION).astype(np.int64)
+        length = int(bins.max()) + 1
+        # zero padded, no wrap around; a power of two keeps the FFT fast
+        size = 1 << (2 * length - 1).bit_length()
+    else:
+        length = max(1, int(round(duration / RESOLUTION)))
+        bins = np.rint(onsets / RESOLUTION).astype(np.int64) % length
+        size = length  # a loop wraps around
+
+    envelope = np.bincount(bins, weights=velocities, minlength=length)
+
+    # tolerate the timing jitter
+    width = int(3 * JITTER / RESOLUTION)
+    kernel = np.exp(-0.5 * (np.arange(-width, width + 1)
+                            * RESOLUTION / JITTER) ** 2)
+    envelope = np.convolve(envelope, kernel, mode='same')
+
+    spectrum = np.fft.rfft(envelope, size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), size)[:length]
+
+    lags = np.arange(len(autocorrelation)) * RESOLUTION
+    first = int(60.0 / MAX_BPM / RESOLUTION)
+    last = min(int(60.0 / MIN_BPM / RESOLUTION) + 1, len(autocorrelation))
+    if duration is not None:
+        last = min(last, length // 2 + 1)
+    if last - first < 3:
+        return None
+
+    candidates = lags[first:last]
+    weights = np.exp(-0.5 * (np.log2(60.0 / candidates / PREFERRED_BPM)
+                             / PREFERENCE_WIDTH) ** 2)
+    peak = first + int(np.argmax(autocorrelation[first:last] * weights))
+    beat = _refine_peak(autocorrelation, peak) * RESOLUTION
+
+    if duration is not None:
+        n_beats = max(1, int(round(duration / beat)))
+        beat = duration / n_beats
+    else:
+        # the peak a few beats away, divided back, is more precise
+        n_beats = 8
+        while n_beats > 1 and n_beats * peak + 1 >= len(autocorrelation):
+            n_beats //= 2
+        far_peak = _find_peak(autocorrelation, n_beats * beat / RESOLUTION)
+        beat = _refine_peak(autocorrelation, far_peak) * RESOLUTION / n_beats
+
+    return 60.0 / beat, _beats_per_bar(
+        autocorrelation, beat, None if duration is None else n_beats)
+
+
+def _find_peak(values, around):
+    """Index of the highest value within 2% of around."""
+    radius = max(1, int(around * 0.02))
+    start = max(0, int(round(around)) - radius)
+    end = min(len(values), int(round(around)) + radius + 1)
+    return start + int(values[start:end].argmax())
+
+
+def _refine_peak(values, peak):
+    """Sub-bin peak position, by parabolic interpolation."""
+    if peak <= 0 or peak >= len(values) - 1:
+        return float(peak)
+    left, center, right = values[peak - 1], values[peak], values[peak + 1]
+    curvature = left - 2 * center + right
+    if curvature >= 0:
+        return float(peak)
+    return peak + 0.5 * (left - right) / curvature
+
+
+def _beats_per_bar(autocorrelation, beat, n_beats=None):
+    # a loop usually lasts whole bars
+    if n_beats is not None:
+        if n_beats % 4 == 0:
+            return 4
+        if n_beats % 3 == 0:
+            return 3
+
+    strength = {}
+    for beats in (3, 4):
+        lag = beats * beat / RESOLUTION
+        if lag + 1 >= len(autocorrelation):
+            return 4
+        strength[beats] = autocorrelation[_find_peak(autocorrelation, lag)]
+    return 3 if strength[3] > strength[4] else 4
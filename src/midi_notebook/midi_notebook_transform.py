@@ -0,0 +1,179 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Real time transforms of the loops: transpose, velocity curve, channel
+remap and note filter, compiled to byte lookup tables.
+
+A loop plays its take through the tables of loop.transform: the context
+compiles the tables of a new LoopTransform, then assigns it, and the player
+swaps them from the next event on.
+"""
+
+DROP = 0xFF  # in a note table: the note is filtered out
+
+
+class TransformTables():
+
+    """Byte tables: status (256 entries), note and velocity (128)."""
+
+    def __init__(self, status_table, note_table, velocity_table):
+        self.status_table = status_table
+        self.note_table = note_table
+        self.velocity_table = velocity_table
+
+    @staticmethod
+    def new_buffers(messages):
+        """Output buffers for apply(), one per message: allocated once per
+        take and reused at every cycle."""
+        return [[0 for byte in range(len(m))] for m in messages], \
+            [None for m in messages]
+
+    @staticmethod
+    def new_sounding():
+        """Output status and note of the notes on, per input channel and
+        note: note offs follow their note on even if the tables changed."""
+        return bytearray(16 * 128), bytearray([DROP for n in range(16 * 128)])
+
+    def apply(self, messages, start, end, buffers, outgoing, sounding):
+        """outgoing[n] = messages[n] transformed in buffers[n], None if
+        filtered out, for n in start:end."""
+        status_table = self.status_table
+        note_table = self.note_table
+        velocity_table = self.velocity_table
+        sounding_status, sounding_note = sounding
+
+        for n in range(start, end):
+            message = messages[n]
+            buffer = buffers[n]
+            status = message[0]
+
+            if status < 0x80 or status >= 0xF0 or len(buffer) > 3:
+                outgoing[n] = message  # system messages: as recorded
+                continue
+
+            kind = status & 0xF0
+            buffer[0] = status_table[status]
+
+            if kind >= 0xB0:  # controllers, programs, pressure, pitch bend
+                for byte in range(1, len(buffer)):
+                    buffer[byte] = message[byte]
+                outgoing[n] = buffer
+                continue
+
+            # note on, note off, polyphonic pressure
+            key = ((status & 0x0F) << 7) | message[1]
+            if kind == 0x90 and message[2] > 0:
+                note = note_table[message[1]]
+                if note == DROP:
+                    outgoing[n] = None
+                    continue
+                buffer[1] = note
+                buffer[2] = velocity_table[message[2]]
+                sounding_status[key] = buffer[0]
+                sounding_note[key] = note
+            elif kind == 0xA0:
+                note = note_table[message[1]]
+                if note == DROP:
+                    outgoing[n] = None
+                    continue
+                buffer[1] = note
+                buffer[2] = message[2]
+            else:  # note off
+                note = sounding_note[key]
+                if note == DROP:
+                    # not started by us: current tables
+                    note = note_table[message[1]]
+                    if note == DROP:
+                        outgoing[n] = None
+                        continue
+                else:
+                    buffer[0] = (status & 0xF0) | (sounding_status[key] & 0x0F)
+                    sounding_note[key] = DROP
+                buffer[1] = note
+                buffer[2] = message[2]
+
+            outgoing[n] = buffer
+
+    def transform_message(self, message, sounding):
+        """A transformed clone of message, None if filtered out (exports):
+        sounding pairs the note offs as apply() did when playing."""
+        result = message.clone()
+        outgoing = [None]
+        self.apply([message], 0, 1, [result], outgoing, sounding)
+        return None if outgoing[0] is None else result
+
+
+class LoopTransform():
+
+    """transpose: semitones
+    velocity_curve: exponent of the velocity curve (< 1 louder, > 1 softer)
+    velocity_scale: velocity multiplier, after the curve
+    channel_map: {input channel: output channel}, channels 0-15
+    note_range: (lowest, highest) input note played
+    muted_notes: input notes not played
+    """
+
+    def __init__(self, transpose=0, velocity_curve=1.0, velocity_scale=1.0,
+                 channel_map=None, note_range=(0, 127), muted_notes=()):
+        self.transpose = transpose
+        self.velocity_curve = velocity_curve
+        self.velocity_scale = velocity_scale
+        self.channel_map = dict(channel_map or {})
+        self.note_range = note_range
+        self.muted_notes = frozenset(muted_notes)
+        self._tables = {}  # output channel -> TransformTables
+
+    def tables(self, channel=None):
+        """Compiled tables, all channels sent to channel if not None."""
+        tables = self._tables.get(channel)
+        if tables is None:
+            tables = TransformTables(self._compile_status_table(channel),
+                                     self._compile_note_table(),
+                                     self._compile_velocity_table())
+            self._tables[channel] = tables
+        return tables
+
+    def _compile_status_table(self, channel):
+        table = bytearray(range(256))
+        for status in range(0x80, 0xF0):
+            output_channel = channel
+            if output_channel is None:
+                output_channel = self.channel_map.get(status & 0x0F, status & 0x0F)
+            table[status] = (status & 0xF0) | output_channel
+        return bytes(table)
+
+    def _compile_note_table(self):
+        lowest, highest = self.note_range
+        table = bytearray(128)
+        for note in range(128):
+            output_note = note + self.transpose
+            if note < lowest or note > highest or note in self.muted_notes or \
+                    not 0 <= output_note < 128:
+                output_note = DROP
+            table[note] = output_note
+        return bytes(table)
+
+    def _compile_velocity_table(self):
+        table = bytearray(128)
+        for velocity in range(1, 128):
+            output_velocity = 127 * (velocity / 127.0) ** self.velocity_curve * \
+                self.velocity_scale
+            # 0 would turn a note on into a note off
+            table[velocity] = max(1, min(127, int(round(output_velocity))))
+        return bytes(table)
+
+
+IDENTITY = LoopTransform()
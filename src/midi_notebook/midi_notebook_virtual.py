@@ -0,0 +1,134 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process MIDI backend with the rtmidi_python MidiIn/MidiOut interface.
+
+Pass an instance as the 'midi_backend' configuration entry to run the
+context without MIDI hardware.
+"""
+
+import threading
+
+from midi_notebook.midi_notebook_clock import RealClock
+
+
+class VirtualMidiIn():
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.callback = None
+        self.port = None
+
+    @property
+    def ports(self):
+        return self.backend.input_port_names
+
+    def open_port(self, port):
+        self.port = port
+        self.backend.inputs[port].append(self)
+
+    def close_port(self):
+        if self.port is not None:
+            self.backend.inputs[self.port].remove(self)
+            self.port = None
+
+
+class VirtualMidiOut():
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.port = None
+
+    @property
+    def ports(self):
+        return self.backend.output_port_names
+
+    def open_port(self, port):
+        self.port = port
+
+    def close_port(self):
+        self.port = None
+
+    def send_message(self, message):
+        self.backend.output_received(self.port, message)
+
+
+class VirtualMidiBackend():
+
+    def __init__(self, n_inputs=1, n_outputs=1, clock=None):
+        self.clock = clock
+        if self.clock is None:
+            self.clock = RealClock()
+
+        self.input_port_names = [
+            'Virtual In {0}'.format(n).encode('utf-8') for n in range(n_inputs)]
+        self.output_port_names = [
+            'Virtual Out {0}'.format(n).encode('utf-8') for n in range(n_outputs)]
+
+        self.inputs = [[] for n in range(n_inputs)]  # open MidiIn per port
+        self.last_input_time = [None for n in range(n_inputs)]
+
+        self.lock = threading.Lock()
+        self.sent_count = [0 for n in range(n_outputs)]
+        self.loopback = {}  # output port -> input port
+        self.loopback_latency = {}  # output port -> seconds, on the loopback
+        self.delivery_lock = threading.Lock()
+        self.output_log = None  # set to a list to log (time, port, message)
+
+    def MidiIn(self):
+        return VirtualMidiIn(self)
+
+    def MidiOut(self):
+        return VirtualMidiOut(self)
+
+    def send_input(self, port, data):
+        """Deliver a message to the callbacks listening on an input port.
+
+        As in rtmidi, the time stamp is the delta from the previous message.
+        """
+        now = self.clock.time()
+        last = self.last_input_time[port]
+        self.last_input_time[port] = now
+        time_stamp = 0.0 if last is None else now - last
+
+        for midi_in in self.inputs[port][:]:
+            if midi_in.callback is not None:
+                midi_in.callback(list(data), time_stamp)
+
+    def output_received(self, port, message):
+        with self.lock:
+            self.sent_count[port] += 1
+            if self.output_log is not None:
+                self.output_log.append((self.clock.time(), port, message[:]))
+
+        if port in self.loopback:
+            latency = self.loopback_latency.get(port, 0)
+            if latency > 0:
+                self.clock.add_thread()
+                delivery = threading.Thread(target=self._deliver_later, args=(
+                    latency, self.loopback[port], message[:]))
+                delivery.daemon = True
+                delivery.start()
+            else:
+                self.send_input(self.loopback[port], message[:])
+
+    def _deliver_later(self, latency, port, message):
+        try:
+            self.clock.sleep(latency)
+            with self.delivery_lock:  # one at a time, as from a real port
+                self.send_input(port, message)
+        finally:
+            self.clock.remove_thread()
@@ -0,0 +1,126 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""MIDI Notebook batch exporter: re-renders archived sessions to MIDI files."""
+
+import os
+import sys
+import glob
+import time
+import multiprocessing
+
+from midi_notebook import midi_notebook_export
+
+SESSION_FILE_PATTERN = '*.session'
+OUTPUT_SUBDIR = 'export'  # default: the live saves are not overwritten
+
+
+def export_session(job):
+    session_path, output_dir, bpm, split_loops, quantize_grid = job
+
+    messages, session_bpm, quantize = midi_notebook_export.read_session(session_path)
+    if bpm is None:
+        bpm = session_bpm
+
+    # as the live save, unless another grid (0 = none) is given
+    if quantize_grid is not None:
+        strength, swing = (1.0, 0.0) if quantize is None else quantize[1:]
+        quantize = None if quantize_grid == 0 else (quantize_grid, strength, swing)
+
+    if quantize is not None:
+        from midi_notebook.midi_notebook_quantize import quantize_messages
+        grid, strength, swing = quantize
+        messages = quantize_messages(messages, grid * 60.0 / bpm, strength, swing)
+
+    my_midi = midi_notebook_export.build_midi_file(messages, bpm, split_loops)
+
+    file_name = os.path.splitext(os.path.basename(session_path))[0]
+    if bpm != session_bpm:
+        file_name += '_{0}bpm'.format(bpm)
+    if split_loops:
+        file_name += '_loops'
+    if quantize_grid == 0:
+        file_name += '_unquantized'
+    elif quantize_grid is not None:
+        file_name += '_quantized'
+    file_path = os.path.join(output_dir, file_name + '.mid')
+    midi_notebook_export.write_midi_file(my_midi, file_path)
+
+    return file_path, len(messages)
+
+
+def print_usage():
+    print("Usage: {0} SESSION_DIR [-bpmBPM] [-split] [-quantizeGRID] [-jJOBS] [-outDIR]".format(
+        os.path.basename(sys.argv[0])))
+    print("-bpmBPM: Tempo of the exported files (default: as recorded).")
+    print("-split: One track per loop.")
+    print("-quantizeGRID: Quantize notes to GRID beats, e.g. 0.25, with the recorded strength and swing; 0 = not quantized (default: as saved live).")
+    print("-jJOBS: Number of worker processes (default: one per CPU).")
+    print("-outDIR: Output directory (default: SESSION_DIR/{0}).".format(OUTPUT_SUBDIR))
+
+
+def main():
+    session_dir = None
+    output_dir = None
+    bpm = None
+    split_loops = False
+    jobs = None
+    quantize_grid = None
+
+    for arg in sys.argv[1:]:
+        if arg.startswith("-bpm"):
+            bpm = int(arg[4:])
+        elif arg == "-split":
+            split_loops = True
+        elif arg.startswith("-quantize"):
+            quantize_grid = float(arg[9:])
+        elif arg.startswith("-j"):
+            jobs = int(arg[2:])
+        elif arg.startswith("-out"):
+            output_dir = arg[4:]
+        elif not arg.startswith("-"):
+            session_dir = arg
+
+    if session_dir is None:
+        print_usage()
+        sys.exit(1)
+
+    if output_dir is None:
+        output_dir = os.path.join(session_dir, OUTPUT_SUBDIR)
+    os.makedirs(output_dir, exist_ok=True)
+
+    session_paths = sorted(
+        glob.glob(os.path.join(session_dir, SESSION_FILE_PATTERN)))
+    if not session_paths:
+        print("No sessions found in {0}.".format(session_dir))
+        return
+
+    work = [(path, output_dir, bpm, split_loops, quantize_grid)
+            for path in session_paths]
+
+    start = time.time()
+    total_messages = 0
+    with multiprocessing.Pool(jobs) as pool:
+        for n, (file_path, n_messages) in enumerate(pool.imap_unordered(export_session, work)):
+            total_messages += n_messages
+            print("[{0}/{1}] {2} ({3} messages)".format(
+                n + 1, len(work), os.path.basename(file_path), n_messages))
+
+    print("Exported {0} sessions ({1} MIDI messages) in {2:.1f}sec.".format(
+        len(work), total_messages, time.time() - start))
+
+if __name__ == '__main__':
+    main()
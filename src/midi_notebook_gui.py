@@ -36,6 +36,13 @@ CONFIGURATION = {
     # MIDI export file pattern ({0} = datetime)
     'midi_file_name': 'midi_notebook_{0}.mid',
 
+    # raw session archive for midi_notebook_batch.py ({0} = datetime)
+    # (None = no archive)
+    'session_file_name': 'midi_notebook_{0}.session',
+
+    # keep the search index of midi_notebook_search.py up to date
+    'index_midi_files': False,
+
     # beats per minute for MIDI files
     'bpm': 120,
 
@@ -45,6 +52,19 @@ CONFIGURATION = {
     # signatures for loop control special messages
     'loop_toggle_message_signature':
     [[21, 127], [22, 127], [23, 127], [24, 127], ],
+
+    # localhost UDP port for loop commands (None = disabled)
+    'control_port': None,
+
+    # quantize loop takes and MIDI files: grid in beats, e.g. 0.25 = 1/16
+    # (None = off), strength 0-1, swing 0-1 of a grid step (1/3 = triplets)
+    'quantize_grid': None,
+    'quantize_strength': 1.0,
+    'quantize_swing': 0.0,
+
+    # MIDI file tempo detected from the master loop ('loop') or the session
+    # ('session'), None = bpm
+    'tempo_detection': None,
 }
 # /CONFIGURATION
 
@@ -53,6 +73,8 @@ class Application():
 
     """The ugly tkinter Application"""
 
+    REFRESH_INTERVAL = 300  # ms, also the blinking period
+
     def __init__(self, context):
         self.blink = 0
 
@@ -69,9 +91,21 @@ class Application():
         self.loop_midi_values = []
         self.root = None
         self.output_port = None
+        self.loop_output_ports = []
+        self.loop_output_channels = []
+        self.loop_transpose = []
         self.txt = None
+        self.stats_label = None
+        self.rendered_stats_time = None
+
+        # versions of the context state on screen
+        self.rendered_state_version = None
+        self.rendered_signature_version = None
+        self.rendered_loop_versions = [None for n in range(context.n_loops)]
+        self.blinking_loops = [False for n in range(context.n_loops)]
 
         self.build_gui()
+        self.render_all()
         self.midi_message_loop()
 
     def build_gui(self):
@@ -89,6 +123,7 @@ class Application():
         self.root.rowconfigure(0, weight=1)
         self.root.rowconfigure(1, weight=0, minsize=140)
         self.root.rowconfigure(2, weight=0, minsize=2)
+        self.root.rowconfigure(3, weight=0)
 
         self.txt = tkinter.Text(
             self.root, height='20', width='90', bg='black', fg='#33ff33')
@@ -135,6 +170,10 @@ class Application():
 
             self.root.columnconfigure(n, weight=1)
 
+        self.stats_label = tkinter.Label(self.root, anchor=tkinter.W)
+        self.stats_label.grid(row=3, column=0, columnspan=self.context.n_loops,
+                              sticky=tkinter.W + tkinter.E)
+
         self.default_button_colors = (self.loop_buttons[0]['fg'],
                                       self.loop_buttons[0]['bg'])
 
@@ -158,16 +197,41 @@ class Application():
         # menu/tools
         tools = tkinter.Menu(menubar, tearoff=0)
 
+        # filled on first use: ports are scanned while the GUI is built
         ports = tkinter.Menu(tools, tearoff=0)
+        ports.configure(
+            postcommand=functools.partial(self.build_output_ports_menu, ports))
         self.output_port = tkinter.IntVar()
         self.output_port.set(self.context.output_port)
 
-        for n, port_name in enumerate(self.context.get_output_ports()):
-            ports.add_radiobutton(label="[{0}] {1}".format(n, port_name.decode('utf-8')), variable=self.output_port,
-                                  value=n, command=functools.partial(self.set_output_port, value=n))
-
         tools.add_cascade(label="Select MIDI out port", menu=ports)
 
+        loop_outputs = tkinter.Menu(tools, tearoff=0)
+        for n in range(self.context.n_loops):
+            self.loop_output_ports.append(tkinter.IntVar())
+            self.loop_output_channels.append(tkinter.IntVar())
+            loop_output = tkinter.Menu(loop_outputs, tearoff=0)
+            loop_output.configure(postcommand=functools.partial(
+                self.build_loop_output_menu, n, loop_output))
+            loop_outputs.add_cascade(label="Loop {0}".format(n), menu=loop_output)
+        tools.add_cascade(label="Loop outputs", menu=loop_outputs)
+
+        loop_transpose = tkinter.Menu(tools, tearoff=0)
+        for n in range(self.context.n_loops):
+            self.loop_transpose.append(tkinter.IntVar())
+            transpose = tkinter.Menu(loop_transpose, tearoff=0)
+            for semitones in (12, 7, 5, 2, 1, 0, -1, -2, -5, -7, -12):
+                transpose.add_radiobutton(label="{0:+d}".format(semitones) if semitones else "As recorded",
+                                          variable=self.loop_transpose[n], value=semitones,
+                                          command=functools.partial(self.set_loop_transpose, n))
+            loop_transpose.add_cascade(label="Loop {0}".format(n), menu=transpose)
+        tools.add_cascade(label="Loop transpose", menu=loop_transpose)
+
+        calibration = tkinter.Menu(tools, tearoff=0)
+        calibration.configure(postcommand=functools.partial(
+            self.build_calibration_menu, calibration))
+        tools.add_cascade(label="Calibrate output latency", menu=calibration)
+
         tools.add_command(label="Reset song and loops",
                           command=self.clean_all)
 
@@ -176,70 +240,190 @@ class Application():
 
         return menubar
 
+    def build_output_ports_menu(self, ports):
+        if ports.index(tkinter.END) is not None:
+            return  # already built
+
+        self.output_port.set(self.context.output_port)
+        for n, port_name in enumerate(self.context.get_output_ports()):
+            ports.add_radiobutton(label="[{0}] {1}".format(n, port_name.decode('utf-8')), variable=self.output_port,
+                                  value=n, command=functools.partial(self.set_output_port, value=n))
+
+    def build_loop_output_menu(self, n, menu):
+        # -1 = default port / channel as recorded
+        port = self.context.loop_output_ports[n]
+        channel = self.context.loop_output_channels[n]
+        self.loop_output_ports[n].set(-1 if port is None else port)
+        self.loop_output_channels[n].set(-1 if channel is None else channel)
+
+        if menu.index(tkinter.END) is not None:
+            return  # already built
+
+        menu.add_radiobutton(label="Default MIDI out port", variable=self.loop_output_ports[n],
+                             value=-1, command=functools.partial(self.set_loop_output, n))
+        for port_n, port_name in enumerate(self.context.get_output_ports()):
+            menu.add_radiobutton(label="[{0}] {1}".format(port_n, port_name.decode('utf-8')),
+                                 variable=self.loop_output_ports[n],
+                                 value=port_n, command=functools.partial(self.set_loop_output, n))
+
+        menu.add_separator()
+
+        menu.add_radiobutton(label="Channel as recorded", variable=self.loop_output_channels[n],
+                             value=-1, command=functools.partial(self.set_loop_output, n))
+        for channel_n in range(16):
+            menu.add_radiobutton(label="Channel {0}".format(channel_n + 1),
+                                 variable=self.loop_output_channels[n],
+                                 value=channel_n, command=functools.partial(self.set_loop_output, n))
+
+    def set_loop_transpose(self, n):
+        from midi_notebook.midi_notebook_transform import LoopTransform
+        semitones = self.loop_transpose[n].get()
+        self.context.set_loop_transform(
+            n, LoopTransform(transpose=semitones) if semitones else None)
+
+    def build_calibration_menu(self, menu):
+        if menu.index(tkinter.END) is not None:
+            return  # already built
+
+        for n, port_name in enumerate(self.context.get_input_ports()):
+            menu.add_command(label="Loopback to [{0}] {1}".format(n, port_name.decode('utf-8')),
+                             command=functools.partial(self.calibrate, n))
+
+    def calibrate(self, input_port):
+        def run():
+            from midi_notebook.midi_notebook_calibration import calibrate
+            calibrate(self.context, input_port)
+            conf = Configuration()
+            conf.write(self.context)
+
+        # probes take a while: not in the GUI thread
+        calibration = threading.Thread(target=run)
+        calibration.daemon = True
+        calibration.start()
+
+    def set_loop_output(self, n):
+        port = self.loop_output_ports[n].get()
+        channel = self.loop_output_channels[n].get()
+        self.context.set_loop_output(
+            n, None if port < 0 else port, None if channel < 0 else channel)
+        conf = Configuration()
+        conf.write(self.context)
+
     def cb_updating_midi_config(self, evt):
         self.midi_config_changing = True
 
     def cb_update_midi_config(self, n, evt):
-        self.context.loop_toggle_message_signature[n] = [
-            self.loop_midi_ccn[n].get(), self.loop_midi_values[n].get()]
         self.midi_config_changing = False
+        self.context.set_loop_toggle_message_signature(n, [
+            self.loop_midi_ccn[n].get(), self.loop_midi_values[n].get()])
         conf = Configuration()
         conf.write(self.context)
 
     def midi_message_loop(self):
+        self.refresh()
+        self.root.after(self.REFRESH_INTERVAL, self.midi_message_loop)
+
+    def refresh(self):
+        """Redraw only what changed since the last call, and blink."""
         self.blink = 1 - self.blink
 
-        playback_colors = [self.default_button_colors,
-                           self.default_button_colors[::-1]]
+        self.flush_messages()
 
-        record_colors = [self.record_button_colors,
-                         self.record_button_colors[::-1]]
+        if self.context.state_version != self.rendered_state_version:
+            self.rendered_state_version = self.context.state_version
+
+            for n, l in enumerate(self.context.loops):
+                if l.version != self.rendered_loop_versions[n]:
+                    self.render_loop(n)
+
+            if not self.midi_config_changing and \
+                    self.context.signature_version != self.rendered_signature_version:
+                self.render_signatures()
+
+        for n in range(self.context.n_loops):
+            if self.blinking_loops[n]:
+                self.render_loop_colors(n)
+
+        # the rates move with time too: once a second
+        now = self.context.clock.time()
+        if self.rendered_stats_time is None or now - self.rendered_stats_time >= 1:
+            self.render_stats(now)
+
+    def render_stats(self, now):
+        self.rendered_stats_time = now
+        self.stats_label.config(text=self.context.stats.summary(now))
+
+    def render_all(self):
+        self.flush_messages()
+        self.rendered_state_version = self.context.state_version
+        for n in range(self.context.n_loops):
+            self.render_loop(n)
+        self.render_signatures()
+        self.render_stats(self.context.clock.time())
+
+    def flush_messages(self):
+        if not self.update_messages:
+            return
 
         self.update_lock.acquire()
         while len(self.update_messages) > 0:
             msg = self.update_messages.pop(0)
             self.txt.insert(tkinter.INSERT, msg)
-            self.txt.see(tkinter.END)
         self.update_lock.release()
+        self.txt.see(tkinter.END)
 
-        for n, l in enumerate(self.context.loops):
-            # status and blinking
-
-            self.loop_buttons[n][
-                'text'] = 'Loop ' + str(n) + (' master' if n == 0 else '') + '\n' + l.status
-
-            if l.is_recording and l.start_recording_time is None:
-                self.loop_buttons[n]['fg'], self.loop_buttons[n]['bg'], =\
-                    record_colors[self.blink][0],\
-                    record_colors[self.blink][1]
-            elif l.is_recording:
-                self.loop_buttons[n]['fg'], self.loop_buttons[n]['bg'], =\
-                    self.record_button_colors[1],\
-                    self.record_button_colors[0]
-            elif l.is_playback:
-                if l.waiting_for_sync:
-                    self.loop_buttons[n]['fg'], self.loop_buttons[n]['bg'] =\
-                        playback_colors[self.blink][0],\
-                        playback_colors[self.blink][1]
-                else:
-                    self.loop_buttons[n]['fg'], self.loop_buttons[n]['bg'] =\
-                        self.default_button_colors[1],\
-                        self.default_button_colors[0]
-            else:
-                self.loop_buttons[n].configure(
-                    fg=self.default_button_colors[0],
-                    bg=self.default_button_colors[1])
+    def render_loop(self, n):
+        l = self.context.loops[n]
+        self.rendered_loop_versions[n] = l.version
+
+        self.loop_buttons[n][
+            'text'] = 'Loop ' + str(n) + (' master' if n == 0 else '') + '\n' + l.status
+        self.render_loop_colors(n)
 
-            # MIDI ccn and values config
-            if not self.midi_config_changing:
-                self.loop_midi_ccn[n].set(
-                    self.context.loop_toggle_message_signature[n][0])
-                self.loop_midi_values[n].set(
-                    self.context.loop_toggle_message_signature[n][1])
+    def render_loop_colors(self, n):
+        l = self.context.loops[n]
 
-        self.root.update()
+        playback_colors = [self.default_button_colors,
+                           self.default_button_colors[::-1]]
 
-        self.root.after(300, self.midi_message_loop)
+        record_colors = [self.record_button_colors,
+                         self.record_button_colors[::-1]]
+
+        self.blinking_loops[n] = False
+
+        if l.is_recording and l.start_recording_time is None:
+            self.blinking_loops[n] = True
+            self.loop_buttons[n]['fg'], self.loop_buttons[n]['bg'], =\
+                record_colors[self.blink][0],\
+                record_colors[self.blink][1]
+        elif l.is_recording:
+            self.loop_buttons[n]['fg'], self.loop_buttons[n]['bg'], =\
+                self.record_button_colors[1],\
+                self.record_button_colors[0]
+        elif l.is_playback:
+            if l.waiting_for_sync:
+                self.blinking_loops[n] = True
+                self.loop_buttons[n]['fg'], self.loop_buttons[n]['bg'] =\
+                    playback_colors[self.blink][0],\
+                    playback_colors[self.blink][1]
+            else:
+                self.loop_buttons[n]['fg'], self.loop_buttons[n]['bg'] =\
+                    self.default_button_colors[1],\
+                    self.default_button_colors[0]
+        else:
+            self.loop_buttons[n].configure(
+                fg=self.default_button_colors[0],
+                bg=self.default_button_colors[1])
+
+    def render_signatures(self):
+        self.rendered_signature_version = self.context.signature_version
+
+        # MIDI ccn and values config
+        for n in range(self.context.n_loops):
+            self.loop_midi_ccn[n].set(
+                self.context.loop_toggle_message_signature[n][0])
+            self.loop_midi_values[n].set(
+                self.context.loop_toggle_message_signature[n][1])
 
     def cb_save(self, unused=None):
         self.context.save_midi_file()
@@ -276,6 +460,15 @@ class Recorder(threading.Thread):
         self.context.start_main_loop()
 
 
+def exit_with_usage(context, message):
+    # no window yet: to the log and the console
+    logging.error(message)
+    context.write_message_function = print
+    context.write_message(message)
+    context.print_info()
+    sys.exit(1)
+
+
 def main():
     def cb_error_handler(type, value, tb):
         msg = repr(traceback.format_exception(type, value, tb))
@@ -287,6 +480,7 @@ def main():
     sys.excepthook = cb_error_handler
 
     context = MidiNotebookContext(CONFIGURATION)  # init
+    context.scan_ports()  # in background, while the GUI is built
 
     # read config if exists
     conf = Configuration()
@@ -297,6 +491,23 @@ def main():
             context.input_port = int(arg[3:])
         if arg.startswith("-out"):
             context.output_port = int(arg[4:])
+        if arg.startswith("-control"):
+            context.control_port = int(arg[8:])
+        if arg.startswith("-quantize"):
+            context.quantize_grid = float(arg[9:])
+        if arg.startswith("-tempo"):
+            if arg[6:] not in context.TEMPO_DETECTION_MODES:
+                exit_with_usage(context, "Unknown tempo detection {0}.".format(arg[6:]))
+            context.tempo_detection = arg[6:]
+        if arg.startswith("--profile"):
+            from midi_notebook.midi_notebook_profiler import Profiler, parse_profile_argument
+            mode = parse_profile_argument(arg)
+            if mode not in Profiler.MODES:
+                exit_with_usage(context, "Unknown profile mode in {0}.".format(arg))
+            context.profiler = Profiler(mode)
+
+    if context.profiler is not None:
+        context.profiler.start()
 
     app = Application(context)
 
@@ -305,4 +516,9 @@ def main():
     recorder.start()
     app.root.mainloop()
 
-main()
+    if context.profiler is not None:
+        from midi_notebook.midi_notebook_profiler import stop_profiler
+        stop_profiler(context)
+
+if __name__ == '__main__':
+    main()
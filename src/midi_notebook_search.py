@@ -0,0 +1,113 @@
+# MIDI-Notebook - A prototypal MIDI monitor, looper, and recorder written in Python.
+# Copyright (C) 2014 Massimo Barbieri - http://www.massimobarbieri.it
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""MIDI Notebook search: finds saved MIDI files by melody and features."""
+
+import os
+import sys
+import time
+
+from midi_notebook.midi_notebook_index import MidiIndex, parse_note
+
+
+def parse_melody(text):
+    """"62,65,69" or "D4,F4,A4" -> pitches; without octaves ("D,F,A") each
+    note is the nearest to the previous one."""
+    pitches = []
+    for item in text.split(','):
+        item = item.strip()
+        if item.lstrip('-').isdigit():
+            pitches.append(int(item))
+            continue
+
+        pitch_class, pitch = parse_note(item)
+        if pitch is None:
+            if not pitches:
+                pitch = 60 + pitch_class
+            else:
+                interval = (pitch_class - pitches[-1]) % 12
+                pitch = pitches[-1] + (interval - 12 if interval > 6 else interval)
+        pitches.append(pitch)
+    return pitches
+
+
+def print_usage():
+    print("Usage: {0} MIDI_DIR [-melodyNOTES] [-keyKEY] [-ccN[:MIN]] [-bpmMIN-MAX] [-nRESULTS] [-jJOBS]".format(
+        os.path.basename(sys.argv[0])))
+    print("-melodyNOTES: Notes in any transposition, e.g. 62,65,69,67 or D,F,A,G.")
+    print("-keyKEY: Key, e.g. D or \"Eb minor\".")
+    print("-ccN[:MIN]: Uses controller N (1 = mod wheel) at least MIN times.")
+    print("-bpmMIN-MAX: Tempo range.")
+    print("-nRESULTS: Number of results (default: 20).")
+    print("-jJOBS: Number of worker processes for indexing (default: one per CPU).")
+
+
+def main():
+    midi_dir = None
+    query = {}
+    n_results = 20
+    jobs = None
+
+    for arg in sys.argv[1:]:
+        if arg.startswith("-melody"):
+            query['melody'] = parse_melody(arg[7:])
+        elif arg.startswith("-key"):
+            query['key'] = arg[4:]
+        elif arg.startswith("-cc"):
+            cc, _, min_count = arg[3:].partition(':')
+            query['cc'] = int(cc)
+            if min_count:
+                query['min_cc_count'] = int(min_count)
+        elif arg.startswith("-bpm"):
+            min_bpm, _, max_bpm = arg[4:].partition('-')
+            if min_bpm:
+                query['min_bpm'] = float(min_bpm)
+            if max_bpm:
+                query['max_bpm'] = float(max_bpm)
+        elif arg.startswith("-n"):
+            n_results = int(arg[2:])
+        elif arg.startswith("-j"):
+            jobs = int(arg[2:])
+        elif not arg.startswith("-"):
+            midi_dir = arg
+
+    if midi_dir is None:
+        print_usage()
+        sys.exit(1)
+
+    index = MidiIndex(midi_dir).load()
+
+    start = time.time()
+    n_parsed = index.update(jobs)
+    if n_parsed:
+        print("Indexed {0} new or changed files in {1:.1f}sec.".format(
+            n_parsed, time.time() - start))
+
+    start = time.time()
+    results = index.search(**query)
+    elapsed = time.time() - start
+
+    for score, name in results[:n_results]:
+        features = index.files[name]
+        print("{0:6.2f}  {1}  ({2}, {3:.0f} bpm, {4:.0f}sec, {5} notes)".format(
+            score, name, features['key'], features['bpm'], features['duration'],
+            features['notes']))
+
+    print("{0} of {1} files match ({2:.1f} ms).".format(
+        len(results), len(index.files), elapsed * 1000))
+
+if __name__ == '__main__':
+    main()